@@ -0,0 +1,530 @@
+#!/usr/bin/env python3
+"""Load and latency benchmark of every catalog route
+
+Seeds a synthetic database and drives the routes of catalog.py through the
+Flask test client and/or a real threaded WSGI server with concurrent
+clients. Latency percentiles, throughput and SQL statements per request are
+written as JSON, one result per route and mode.
+
+Usage:
+    python benchmark.py --items 100000 --categories 100 --users 50 \\
+        --requests 200 --concurrency 8 --mode both --output results.json
+"""
+from sqlalchemy import create_engine, event, text
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+WORDS = ['red', 'blue', 'green', 'ball', 'net', 'shoe', 'glove', 'stick',
+         'helmet', 'jersey', 'sock', 'bat', 'racket', 'goal', 'pad', 'bag',
+         'light', 'pro', 'junior', 'classic', 'carbon', 'leather', 'mesh']
+
+
+def seedDatabase(url, items, categories, users, batch_size=10000):
+    # Fill an empty database with users, categories and items, the item
+    # titles are unique inside their category as the app requires
+    from models import User, Category, CatalogItem, createSchema, \
+        repairItemCounts, sequenceNewRows
+    engine = create_engine(url)
+    createSchema(engine)
+    rnd = random.Random(1)
+    with engine.begin() as connection:
+        connection.execute(User.__table__.insert(), [{
+            'name': 'User %d' % i,
+            'email': 'user%d@example.com' % i,
+            'picture': 'https://example.com/%d.png' % i,
+        } for i in range(1, users + 1)])
+        connection.execute(Category.__table__.insert(), [{
+            'name': 'Category %d' % i,
+            'user_id': 1 + i % users,
+        } for i in range(1, categories + 1)])
+        rows = []
+        for i in range(1, items + 1):
+            rows.append({
+                'title': 'Item %d %s' % (i, rnd.choice(WORDS)),
+                'description': ' '.join(
+                    rnd.choice(WORDS) for _ in range(12)),
+                'category_id': 1 + i % categories,
+                'user_id': 1 + i % users,
+            })
+            if len(rows) == batch_size:
+                connection.execute(CatalogItem.__table__.insert(), rows)
+                rows = []
+        if rows:
+            connection.execute(CatalogItem.__table__.insert(), rows)
+        sequenceNewRows(connection)
+    repairItemCounts(engine)
+    engine.dispose()
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile of an already sorted list
+    if not values:
+        return None
+    index = max(0, int(round(fraction * len(values) + 0.5)) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def buildRoutes(items, categories, users, token):
+    # (name, method, url, form data, logged in) for the i-th request of each
+    # route. Write routes work on records created by the benchmark itself,
+    # named after token, so they do not depend on the seeded data and can
+    # run concurrently
+    def item(i):
+        return 1 + i * 7919 % items
+
+    def category(i):
+        return 1 + i % categories
+
+    return [
+        ('showCategories', 'GET', lambda i: '/catalog', None, False),
+        ('showCategories (logged in)', 'GET', lambda i: '/catalog', None,
+         True),
+        ('showCatalogItem', 'GET',
+         lambda i: '/catalog/Category %d' % category(i), None, False),
+        ('showLogin', 'GET', lambda i: '/login', None, False),
+        ('catalogItemsJSON', 'GET', lambda i: '/catalog/item/JSON', None,
+         False),
+        ('catalogItemsJSON (after)', 'GET',
+         lambda i: '/catalog/item/JSON?after=%d' % item(i), None, False),
+        ('catalogItemsJSON (ids)', 'GET',
+         lambda i: '/catalog/item/JSON?ids=%s' % ','.join(
+             str(item(i + n)) for n in range(MULTIGET_IDS)), None, False),
+        ('catalogItemsNDJSON', 'GET', lambda i: '/catalog/item/NDJSON',
+         None, False),
+        ('categoryIdItemJSON', 'GET',
+         lambda i: '/catalog/%d/item/JSON' % category(i), None, False),
+        ('categoryNameItemJSON', 'GET',
+         lambda i: '/catalog/Category %d/item/JSON' % category(i), None,
+         False),
+        ('categoryIdItemIdJSON', 'GET',
+         lambda i: '/catalog/%d/item/%d/JSON' % (
+             1 + item(i) % categories, item(i)), None, False),
+        ('categoriesJSON', 'GET', lambda i: '/catalog/JSON', None, False),
+        ('categoryIdJSON', 'GET',
+         lambda i: '/catalog/%d/JSON' % category(i), None, False),
+        ('categoryNameJSON', 'GET',
+         lambda i: '/catalog/Category %d/JSON' % category(i), None, False),
+        ('catalogUsersJSON', 'GET', lambda i: '/catalog/user/JSON', None,
+         False),
+        ('catalogUsersJSON (ids)', 'GET',
+         lambda i: '/catalog/user/JSON?ids=%s' % ','.join(
+             str(1 + (i + n) % users) for n in range(MULTIGET_IDS)), None,
+         False),
+        ('catalogChangesJSON', 'GET',
+         lambda i: '/catalog/changes/JSON?since=%d' % item(i), None, False),
+        ('catalogStatsJSON', 'GET', lambda i: '/catalog/stats/JSON', None,
+         False),
+        ('catalogUserJSON', 'GET',
+         lambda i: '/catalog/user/%d/JSON' % (1 + i % users), None, False),
+        ('searchJSON', 'GET',
+         lambda i: '/search/JSON?q=%s' % WORDS[i % len(WORDS)], None, False),
+        ('showSearch', 'GET',
+         lambda i: '/search?q=%s' % WORDS[i % len(WORDS)], None, False),
+        ('showMetrics', 'GET', lambda i: '/metrics', None, False),
+        ('newCategory', 'POST', lambda i: '/catalog/new',
+         lambda i: {'name': 'Bench %s %d' % (token, i)}, True),
+        ('editCategory (form)', 'GET',
+         lambda i: '/catalog/Bench %s %d/edit' % (token, i), None, True),
+        ('newCatalogItem', 'POST', lambda i: '/catalog/item/new',
+         lambda i: {'title': 'Bench item %d' % i, 'description': 'bench',
+                    'category': 'Bench %s %d' % (token, i)}, True),
+        ('showCatalogItemDetails', 'GET',
+         lambda i: '/catalog/Bench %s %d/Bench item %d' % (token, i, i),
+         None, False),
+        ('categoryNameItemNameJSON', 'GET',
+         lambda i: '/catalog/Bench %s %d/Bench item %d/JSON' % (token, i, i),
+         None, False),
+        ('editCatalogItem', 'POST',
+         lambda i: '/catalog/Bench %s %d/Bench item %d/edit' % (token, i, i),
+         lambda i: {'title': 'Bench edited %d' % i, 'description': 'edited',
+                    'category': 'Bench %s %d' % (token, i)}, True),
+        ('deleteCatalogItem', 'POST',
+         lambda i: '/catalog/Bench %s %d/Bench edited %d/delete'
+         % (token, i, i), None, True),
+        ('editCategory', 'POST',
+         lambda i: '/catalog/Bench %s %d/edit' % (token, i),
+         lambda i: {'name': 'Bench %s %d renamed' % (token, i)}, True),
+        ('deleteCategory', 'POST',
+         lambda i: '/catalog/Bench %s %d renamed/delete' % (token, i), None,
+         True),
+        # The category deletes above queued jobs of the logged in user
+        ('jobJSON', 'GET', lambda i: '/catalog/job/%d/JSON' % (1 + i % 10),
+         None, True),
+        ('catalogItemsBatchJSON', 'POST', lambda i: '/catalog/item/batch/JSON',
+         lambda i: json.dumps({'operations': [
+             {'op': 'create', 'title': 'Batch %s %d %d' % (token, i, n),
+              'category_id': category(i)} for n in range(10)]}), True),
+        # One write for every MIXED_READS reads of a category's items, the
+        # readers wait on the writers unless the database uses WAL
+        ('mixedReadWrite', lambda i: 'POST' if mixedWrite(i) else 'GET',
+         lambda i: ('/catalog/item/batch/JSON' if mixedWrite(i) else
+                    '/catalog/%d/item/JSON' % category(i)),
+         lambda i: json.dumps({'operations': [
+             {'op': 'create', 'title': 'Mixed %s %d' % (token, i),
+              'category_id': category(i)}]}) if mixedWrite(i) else None,
+         True),
+    ]
+
+
+# Reads sent between two writes by the mixedReadWrite route
+MIXED_READS = 4
+# Ids asked at once by the multi-get routes
+MULTIGET_IDS = 100
+
+
+def mixedWrite(i):
+    return i % (MIXED_READS + 1) == 0
+
+
+class QueryCounter(object):
+    # Counts the SQL statements run while serving each request, requests are
+    # served by one thread at a time so the count is kept per thread
+
+    def __init__(self, app, engine):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.requests = {}
+        event.listen(engine, 'before_cursor_execute', self.statement)
+        app.before_request(self.start)
+        app.teardown_request(self.stop)
+
+    def start(self):
+        from flask import request
+        self.local.route = request.headers.get('X-Benchmark-Route')
+        self.local.count = 0
+
+    def statement(self, *args):
+        if getattr(self.local, 'route', None) is not None:
+            self.local.count += 1
+
+    def stop(self, exception=None):
+        route = getattr(self.local, 'route', None)
+        if route is None:
+            return
+        with self.lock:
+            self.counts[route] = self.counts.get(route, 0) + self.local.count
+            self.requests[route] = self.requests.get(route, 0) + 1
+        self.local.route = None
+
+    def perRequest(self, route):
+        with self.lock:
+            served = self.requests.pop(route, 0)
+            count = self.counts.pop(route, 0)
+        return float(count) / served if served else None
+
+
+def runRoute(send, route, count, concurrency):
+    # Send count requests of route from concurrency threads, return the
+    # sorted latencies in milliseconds, errors and elapsed seconds
+    name, method, url, data, logged_in = route
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    indexes = iter(range(count))
+
+    def worker():
+        client = send(logged_in)
+        while True:
+            with lock:
+                i = next(indexes, None)
+            if i is None:
+                return
+            body = data(i) if data else None
+            start = time.time()
+            try:
+                status = client(method(i) if callable(method) else method,
+                                url(i), body, name)
+                failed = status >= 400
+            except Exception:
+                failed = True
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if failed:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors[0], time.time() - start
+
+
+def testClientSender(app, cookie):
+    # One Flask test client per benchmark thread
+    def send(logged_in):
+        client = app.test_client()
+        if logged_in:
+            client.set_cookie(
+                'localhost', app.config['SESSION_COOKIE_NAME'], cookie)
+
+        def request(method, url, body, name):
+            headers = {'X-Benchmark-Route': name}
+            if isinstance(body, str) and method == 'POST':
+                return client.open(
+                    url, method=method, data=body, headers=headers,
+                    content_type='application/json').status_code
+            return client.open(
+                url, method=method, data=body, headers=headers).status_code
+        return request
+    return send
+
+
+def serverSender(base_url, app, cookie):
+    # One keep-alive HTTP session per benchmark thread
+    import requests
+
+    def send(logged_in):
+        client = requests.Session()
+        if logged_in:
+            client.cookies.set(app.config['SESSION_COOKIE_NAME'], cookie)
+
+        def request(method, url, body, name):
+            headers = {'X-Benchmark-Route': name}
+            if isinstance(body, str) and method == 'POST':
+                headers['Content-Type'] = 'application/json'
+            return client.request(
+                method, base_url + url, data=body, headers=headers,
+                allow_redirects=False).status_code
+        return request
+    return send
+
+
+STARTUP_SCRIPT = '''
+import json, sys, time
+start = time.time()
+import catalog
+imported = time.time()
+app = catalog.create_app({'DATABASE_URL': sys.argv[1]})
+created = time.time()
+status = app.test_client().get('/catalog/JSON').status_code
+served = time.time()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000.0,
+    'create_app_ms': (created - imported) * 1000.0,
+    'first_request_ms': (served - created) * 1000.0,
+    'status': status,
+}))
+'''
+
+
+def measureStartup(url, runs):
+    # Cold start of a worker: each run is a new interpreter that imports the
+    # application, configures it and serves its first request
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    samples = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-c', STARTUP_SCRIPT, url], cwd=here)
+        samples.append(json.loads(output.decode('utf-8')))
+    summary = {'runs': runs}
+    for key in ('import_ms', 'create_app_ms', 'first_request_ms'):
+        values = sorted(sample[key] for sample in samples)
+        summary[key] = {
+            'p50': percentile(values, 0.50),
+            'p95': percentile(values, 0.95),
+        }
+    return summary
+
+
+# Lookups done by the routes with the index of models.py serving them and
+# the query giving sample parameters
+INDEXED_LOOKUPS = [
+    ('category_by_name', 'ix_category_name',
+     'SELECT id FROM category WHERE name = :name',
+     'SELECT name FROM category ORDER BY random() LIMIT 1000'),
+    ('item_by_category_title', 'ix_category_item_category_id_title',
+     'SELECT id FROM category_item '
+     'WHERE category_id = :category_id AND title = :title',
+     'SELECT category_id, title FROM category_item '
+     'ORDER BY random() LIMIT 1000'),
+    ('user_by_email', 'ix_user_email',
+     'SELECT id FROM "user" WHERE email = :email',
+     'SELECT email FROM "user" ORDER BY random() LIMIT 1000'),
+]
+
+
+def measureIndexes(url, lookups):
+    # Latency of each indexed lookup, then again after dropping the indexes,
+    # which are created back by upgradeSchema before returning
+    from models import upgradeSchema
+    engine = create_engine(url)
+    with engine.connect() as connection:
+        samples = dict(
+            (name, [dict(row) for row in connection.execute(text(sample))])
+            for name, index, query, sample in INDEXED_LOOKUPS)
+
+    def timeLookups():
+        timings = {}
+        with engine.connect() as connection:
+            for name, index, query, sample in INDEXED_LOOKUPS:
+                latencies = []
+                for i in range(lookups):
+                    start = time.time()
+                    connection.execute(
+                        text(query), samples[name][i % len(samples[name])]
+                    ).fetchall()
+                    latencies.append((time.time() - start) * 1000)
+                latencies.sort()
+                timings[name] = {
+                    'p50_ms': percentile(latencies, 0.50),
+                    'p95_ms': percentile(latencies, 0.95),
+                }
+        return timings
+
+    indexed = timeLookups()
+    with engine.begin() as connection:
+        for name, index, query, sample in INDEXED_LOOKUPS:
+            connection.execute(text('DROP INDEX %s' % index))
+    try:
+        unindexed = timeLookups()
+    finally:
+        upgradeSchema(engine)
+        engine.dispose()
+    return dict(
+        (name, {'indexed': indexed[name], 'unindexed': unindexed[name]})
+        for name, index, query, sample in INDEXED_LOOKUPS)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark every route of the catalog application')
+    parser.add_argument('--database', default='benchmark.db',
+                        help='sqlite file seeded for the benchmark')
+    parser.add_argument('--reuse', action='store_true',
+                        help='use the database file if it already exists')
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--categories', type=int, default=50)
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests sent to each route')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--mode', choices=['test-client', 'server', 'both'],
+                        default='both')
+    parser.add_argument('--routes', help='comma separated route names')
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    parser.add_argument('--sqlite-profile', choices=['tuned', 'default'],
+                        default='tuned',
+                        help='SQLite connection profile of the application')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS',
+                        help='also time RUNS cold starts of the application')
+    parser.add_argument('--indexes', type=int, default=0, metavar='LOOKUPS',
+                        help='also time LOOKUPS indexed lookups with and '
+                        'without the indexes')
+    args = parser.parse_args(argv)
+
+    url = 'sqlite:///%s' % os.path.abspath(args.database)
+    if not (args.reuse and os.path.exists(args.database)):
+        if os.path.exists(args.database):
+            os.remove(args.database)
+        start = time.time()
+        seedDatabase(url, args.items, args.categories, args.users)
+        sys.stderr.write('Seeded %d items in %.1fs\n'
+                         % (args.items, time.time() - start))
+
+    if args.startup:
+        startup = measureStartup(url, args.startup)
+        sys.stderr.write('startup import %.1fms create_app %.1fms '
+                         'first request %.1fms\n' % (
+                             startup['import_ms']['p50'],
+                             startup['create_app_ms']['p50'],
+                             startup['first_request_ms']['p50']))
+
+    if args.indexes:
+        indexes = measureIndexes(url, args.indexes)
+        for name in sorted(indexes):
+            sys.stderr.write(
+                '%-28s indexed p50 %7.3fms unindexed p50 %7.3fms\n' % (
+                    name, indexes[name]['indexed']['p50_ms'],
+                    indexes[name]['unindexed']['p50_ms']))
+
+    import catalog
+    app = catalog.create_app({
+        'DATABASE_URL': url,
+        'SQLITE_PROFILE': args.sqlite_profile,
+    })
+    app.secret_key = app.secret_key or 'benchmark'
+    counter = QueryCounter(app, catalog.getEngine())
+    cookie = app.session_interface.get_signing_serializer(app).dumps({
+        'username': 'User 1', 'user_id': 1, 'email': 'user1@example.com',
+        'picture': 'https://example.com/1.png'})
+
+    modes = ['test-client', 'server'] if args.mode == 'both' else [args.mode]
+    results = []
+    for mode in modes:
+        routes = buildRoutes(args.items, args.categories, args.users,
+                             '%d %s' % (os.getpid(), mode))
+        if args.routes:
+            selected = set(args.routes.split(','))
+            routes = [route for route in routes if route[0] in selected]
+        server = None
+        if mode == 'server':
+            from werkzeug.serving import make_server, WSGIRequestHandler
+
+            class QuietHandler(WSGIRequestHandler):
+                def log(self, *args):
+                    pass
+
+            server = make_server('127.0.0.1', 0, app, threaded=True,
+                                 request_handler=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            send = serverSender(
+                'http://127.0.0.1:%d' % server.server_port, app, cookie)
+        else:
+            send = testClientSender(app, cookie)
+        for route in routes:
+            latencies, errors, elapsed = runRoute(
+                send, route, args.requests, args.concurrency)
+            results.append({
+                'route': route[0],
+                'mode': mode,
+                'requests': len(latencies),
+                'errors': errors,
+                'p50_ms': percentile(latencies, 0.50),
+                'p95_ms': percentile(latencies, 0.95),
+                'p99_ms': percentile(latencies, 0.99),
+                'throughput_rps': (
+                    len(latencies) / elapsed if elapsed else None),
+                'queries_per_request': counter.perRequest(route[0]),
+            })
+            sys.stderr.write('%-28s %-11s p50 %7.2fms p99 %7.2fms\n' % (
+                route[0], mode, results[-1]['p50_ms'],
+                results[-1]['p99_ms']))
+        if server:
+            server.shutdown()
+
+    output = json.dumps({
+        'config': {
+            'items': args.items,
+            'categories': args.categories,
+            'users': args.users,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+            'sqlite_profile': args.sqlite_profile,
+        },
+        'results': results,
+        'startup': startup if args.startup else None,
+        'indexes': indexes if args.indexes else None,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Bulk import and export of categories and catalog items
+
+Usage:
+    python bulk.py import categories categories.csv --user-id 1
+    python bulk.py import items items.ndjson --user-id 1 --create-categories
+    python bulk.py export items items.csv
+
+Files ending in .csv are read and written as CSV with a header row, any
+other file (or '-' for stdin/stdout) as newline delimited JSON.
+"""
+from contextlib import contextmanager
+from sqlalchemy import bindparam, create_engine, select
+
+from models import User, Category, CatalogItem, CatalogVersion, \
+    createSchema, configureSqlite, sequenceNewRows
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import sys
+
+# The python 2 csv module reads and writes UTF-8 byte strings
+PY2 = sys.version_info[0] < 3
+
+CATEGORY_FIELDS = ['id', 'name', 'user_id']
+ITEM_FIELDS = ['id', 'title', 'description', 'category', 'category_id',
+               'user_id']
+
+
+@contextmanager
+def openFile(path, mode):
+    # csv needs binary files in python 2 and text files without newline
+    # translation in python 3. Files opened here are closed on exit, stdin
+    # and stdout are left open
+    if path == '-':
+        f = sys.stdin if mode == 'r' else sys.stdout
+        yield f
+        if mode == 'w':
+            f.flush()
+        return
+    if PY2:
+        f = open(path, mode + 'b')
+    else:
+        f = open(path, mode, newline='')
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def decodeRow(row):
+    # Fields of a python 2 csv row as unicode
+    return dict((key.decode('utf-8'), value.decode('utf-8')
+                 if isinstance(value, bytes) else value)
+                for key, value in row.items())
+
+
+def encodeValue(value):
+    # Value of a python 2 csv field as UTF-8 bytes
+    if value is None:
+        return ''
+    if isinstance(value, unicode):  # noqa: F821 (python 2 only)
+        return value.encode('utf-8')
+    return value
+
+
+def readRecords(path, fmt):
+    # Yield one dictionary per record in the file
+    with openFile(path, 'r') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield decodeRow(row) if PY2 else row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def writeRecords(path, fmt, fields, rows):
+    # Write the rows (tuples in the same order as fields) to the file
+    count = 0
+    with openFile(path, 'w') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(fields)
+            for row in rows:
+                if PY2:
+                    writer.writerow([encodeValue(value) for value in row])
+                else:
+                    writer.writerow(
+                        ['' if value is None else value for value in row])
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(fields, row)), sort_keys=True))
+                f.write('\n')
+                count += 1
+    return count
+
+
+def toInt(value):
+    if value in (None, ''):
+        return None
+    return int(value)
+
+
+def bumpCatalogVersion(connection):
+    # Same as the web application so cached JSON responses are invalidated
+    table = CatalogVersion.__table__
+    connection.execute(table.update().where(table.c.id == 1).values(
+        version=table.c.version + 1,
+        modified=datetime.datetime.utcnow()))
+
+
+def adjustItemCounts(connection, rows):
+    # Same item counters of categories and users the web application keeps
+    for table, key in ((Category.__table__, 'category_id'),
+                       (User.__table__, 'user_id')):
+        counts = {}
+        for row in rows:
+            counts[row[key]] = counts.get(row[key], 0) + 1
+        counts.pop(None, None)
+        if counts:
+            connection.execute(
+                table.update().where(table.c.id == bindparam('row_id')).values(
+                    item_count=table.c.item_count + bindparam('delta')),
+                [{'row_id': row_id, 'delta': delta}
+                 for row_id, delta in counts.items()])
+
+
+def insertBatches(connection, table, rows, batch_size):
+    # executemany inserts of batch_size rows at a time
+    for start in range(0, len(rows), batch_size):
+        connection.execute(table.insert(), rows[start:start + batch_size])
+
+
+def importCategories(connection, records, user_id, batch_size):
+    table = Category.__table__
+    existing = set(name for (name,) in connection.execute(
+        select([table.c.name])))
+    rows = []
+    duplicates = 0
+    for record in records:
+        name = record.get('name')
+        if not name or name in existing:
+            duplicates += 1
+            continue
+        existing.add(name)
+        rows.append({
+            'name': name,
+            'user_id': toInt(record.get('user_id')) or user_id,
+        })
+    insertBatches(connection, table, rows, batch_size)
+    return len(rows), duplicates
+
+
+def importItems(connection, records, user_id, batch_size, create_categories):
+    categories = Category.__table__
+    table = CatalogItem.__table__
+    # Category names are resolved to ids with a single query
+    category_ids = dict(
+        (name, category_id) for category_id, name in connection.execute(
+            select([categories.c.id, categories.c.name])))
+    known_ids = set(category_ids.values())
+    rows = []
+    missing = {}
+    skipped = 0
+    for record in records:
+        category_id = toInt(record.get('category_id'))
+        name = record.get('category')
+        if name:
+            category_id = category_ids.get(name)
+            if category_id is None:
+                # Items of unknown categories wait until they are created
+                missing.setdefault(name, []).append(record)
+                continue
+        elif category_id not in known_ids:
+            skipped += 1
+            continue
+        rows.append(itemRow(record, category_id, user_id))
+    if missing and create_categories:
+        names = list(missing)
+        insertBatches(connection, categories, [
+            {'name': name, 'user_id': user_id} for name in names], batch_size)
+        category_ids.update(
+            (name, category_id) for category_id, name in connection.execute(
+                select([categories.c.id, categories.c.name]).where(
+                    categories.c.name.in_(names))))
+        for name in names:
+            for record in missing.pop(name):
+                rows.append(itemRow(record, category_ids[name], user_id))
+    for records in missing.values():
+        skipped += len(records)
+    # Duplicates, against the database and inside the file itself, are
+    # found comparing against a set of (category_id, title) keys
+    existing = set(tuple(row) for row in connection.execute(
+        select([table.c.category_id, table.c.title])))
+    new_rows = []
+    duplicates = 0
+    for row in rows:
+        key = (row['category_id'], row['title'])
+        if not row['title'] or key in existing:
+            duplicates += 1
+            continue
+        existing.add(key)
+        new_rows.append(row)
+    insertBatches(connection, table, new_rows, batch_size)
+    adjustItemCounts(connection, new_rows)
+    return len(new_rows), duplicates + skipped
+
+
+def itemRow(record, category_id, user_id):
+    return {
+        'title': record.get('title'),
+        'description': record.get('description') or None,
+        'category_id': category_id,
+        'user_id': toInt(record.get('user_id')) or user_id,
+    }
+
+
+def exportRows(connection, columns, order_column, batch_size):
+    # Rows are read in batches after the last exported id so memory only
+    # depends on the batch size
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select(columns).where(order_column > last_id).order_by(
+                order_column).limit(batch_size)).fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield tuple(row)
+        last_id = rows[-1][0]
+
+
+def exportCategories(connection, path, fmt, batch_size):
+    table = Category.__table__
+    return writeRecords(path, fmt, CATEGORY_FIELDS, exportRows(
+        connection, [table.c.id, table.c.name, table.c.user_id],
+        table.c.id, batch_size))
+
+
+def exportItems(connection, path, fmt, batch_size):
+    table = CatalogItem.__table__
+    categories = Category.__table__
+    category_names = dict(
+        (category_id, name) for category_id, name in connection.execute(
+            select([categories.c.id, categories.c.name])))
+    rows = exportRows(
+        connection, [table.c.id, table.c.title, table.c.description,
+                     table.c.category_id, table.c.user_id],
+        table.c.id, batch_size)
+    return writeRecords(path, fmt, ITEM_FIELDS, (
+        (item_id, title, description, category_names.get(category_id),
+         category_id, user_id)
+        for item_id, title, description, category_id, user_id in rows))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Bulk import and export of catalog data')
+    parser.add_argument('action', choices=['import', 'export'])
+    parser.add_argument('kind', choices=['categories', 'items'])
+    parser.add_argument('path', help="file to read or write, '-' for stdio")
+    parser.add_argument(
+        '--database', default=os.environ.get(
+            'CATALOG_DATABASE_URL', 'sqlite:///catalog.db'))
+    parser.add_argument('--format', choices=['csv', 'ndjson'])
+    parser.add_argument(
+        '--sqlite-profile', choices=['tuned', 'default'],
+        default=os.environ.get('CATALOG_SQLITE_PROFILE', 'tuned'))
+    parser.add_argument('--user-id', type=int,
+                        help='owner of imported records without user_id')
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--create-categories', action='store_true',
+                        help='create the categories of imported items '
+                        'that are not in the database')
+    args = parser.parse_args(argv)
+    fmt = args.format or ('csv' if args.path.endswith('.csv') else 'ndjson')
+
+    engine = create_engine(args.database)
+    configureSqlite(engine, args.sqlite_profile)
+    createSchema(engine)
+
+    if args.action == 'export':
+        with engine.connect() as connection:
+            if args.kind == 'categories':
+                count = exportCategories(
+                    connection, args.path, fmt, args.batch_size)
+            else:
+                count = exportItems(
+                    connection, args.path, fmt, args.batch_size)
+        sys.stderr.write('%d %s exported\n' % (count, args.kind))
+        return 0
+
+    records = readRecords(args.path, fmt)
+    # The whole file is loaded in a single transaction
+    with engine.begin() as connection:
+        if args.kind == 'categories':
+            added, skipped = importCategories(
+                connection, records, args.user_id, args.batch_size)
+        else:
+            added, skipped = importItems(
+                connection, records, args.user_id, args.batch_size,
+                args.create_categories)
+        if added:
+            sequenceNewRows(connection)
+            bumpCatalogVersion(connection)
+    sys.stderr.write('%d %s imported, %d skipped\n'
+                     % (added, args.kind, skipped))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+from collections import namedtuple, OrderedDict
+
+import threading
+import time
+
+
+class CategoryEntry(namedtuple('CategoryEntry', ['id', 'name', 'user_id'])):
+    # Read only copy of a Category row kept in the directory
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+           'name': self.name,
+           'id': self.id,
+           'user_id': self.user_id,
+        }
+
+
+class CategoryDirectory(object):
+    """Memory resident directory of categories by name and by id"""
+
+    def __init__(self, loader, version):
+        # loader returns (id, name, user_id) tuples ordered by name and
+        # version the current catalog version. A snapshot is only used while
+        # the catalog version is the one it was loaded at, so a write made by
+        # any process is seen by the next lookup
+        self.loader = loader
+        self.version = version
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def _load(self):
+        # The version is read before the categories, a write committed in
+        # between makes the snapshot look older than it is so it is loaded
+        # again, never the other way around
+        version = self.version()
+        categories = [CategoryEntry(*row) for row in self.loader()]
+        return {
+            'version': version,
+            'ordered': categories,
+            'by_name': dict((c.name, c) for c in categories),
+            'by_id': dict((c.id, c) for c in categories),
+        }
+
+    def _get(self):
+        version = self.version()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot['version'] == version:
+            self.hits += 1
+            return snapshot
+        with self._lock:
+            # Another thread may have loaded it while waiting for the lock
+            snapshot = self._snapshot
+            if snapshot is None or snapshot['version'] != version:
+                self.misses += 1
+                snapshot = self._snapshot = self._load()
+            else:
+                self.hits += 1
+        return snapshot
+
+    def all(self):
+        """Return all the categories ordered by name"""
+        return self._get()['ordered']
+
+    def byName(self, name):
+        """Return the category with the given name or None"""
+        return self._get()['by_name'].get(name)
+
+    def byId(self, category_id):
+        """Return the category with the given id or None"""
+        return self._get()['by_id'].get(category_id)
+
+    def refresh(self):
+        """Load the directory again, called after categories are written"""
+        # The new snapshot replaces the old one in a single assignment so
+        # readers see either the old or the new directory, never a mix
+        with self._lock:
+            self.misses += 1
+            self._snapshot = self._load()
+
+    def stats(self):
+        """Return hit and miss counters of the directory"""
+        snapshot = self._snapshot
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(snapshot['ordered']) if snapshot else 0,
+        }
+
+
+class LRUCache(object):
+    """Bounded least recently used cache whose entries expire after ttl"""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Return the value cached for key or None"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or (self.ttl is not None and
+                                 time.time() - entry[0] > self.ttl):
+                self.misses += 1
+                return None
+            # Inserting it again moves the entry to the most recent end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Cache value for key, evicting the least recently used entry"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        """Remove key from the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Remove every entry, called when the cached data changes"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Return hit and miss counters of the cache"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
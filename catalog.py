@@ -1,170 +1,715 @@
 #!/usr/bin/env python3
 from flask import Flask, render_template, request, redirect, \
-    jsonify, url_for, flash, make_response
+    jsonify, url_for, flash, make_response, Response, stream_with_context
 from flask import session as login_session
-
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker
-
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
-
-from models import Base, Category, CatalogItem, User
-
-import httplib2
+from flask import g, has_app_context
+from markupsafe import Markup
+
+from sqlalchemy import create_engine, asc, desc, func, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.exc import IntegrityError
+
+from models import Category, CatalogItem, User, CatalogVersion, \
+    Tombstone, Job, configureSqlite, addTombstones, rebuildSearchIndex, \
+    repairItemCounts, requireUniqueIndexes, SchemaError
+from cache import CategoryDirectory, LRUCache
+from metrics import RequestMetrics
+from jobs import JobQueue
+from serializers import RowSerializer, encodeJSON, encodeMsgpack, toPlain, \
+    msgpack, MSGPACK_MIMETYPES, string_types
+from providers import ProviderError, loadSecrets, exchangeGoogleCode, \
+    googleTokenInfo, googleUserInfo, googleRevoke, facebookExchangeToken, \
+    facebookUserInfo, facebookPicture, facebookRevoke, http as providerHttp
+
+from werkzeug.http import is_resource_modified
+from functools import wraps
+
+import datetime
+import hashlib
 import json
-import requests
+import numbers
+import os
 import random
 import string
+import threading
+import time
 
 app = Flask(__name__)
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+# Provider secrets are read on first use and kept in memory afterwards,
+# the file names can be changed through create_app
+GOOGLE_SECRETS_FILE = 'client_secrets.json'
+FACEBOOK_SECRETS_FILE = 'fb_client_secrets.json'
 
 # Reusing the app name from previous project for authentication purposes
 APPLICATION_NAME = "Restaurant Menu Application"
 
-# Connect to Database and create database session
-engine = create_engine(
-    'sqlite:///catalog.db',
-    connect_args={'check_same_thread': False})
-Base.metadata.bind = engine
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Database location and connection pool sizing, they can be overridden
+# through environment variables when running several worker threads
+DATABASE_URL = os.environ.get('CATALOG_DATABASE_URL', 'sqlite:///catalog.db')
+POOL_SIZE = int(os.environ.get('CATALOG_POOL_SIZE', 10))
+POOL_MAX_OVERFLOW = int(os.environ.get('CATALOG_POOL_MAX_OVERFLOW', 20))
+POOL_TIMEOUT = int(os.environ.get('CATALOG_POOL_TIMEOUT', 30))
+# Connection profile of SQLite databases, see SQLITE_PROFILES in models.py
+SQLITE_PROFILE = os.environ.get('CATALOG_SQLITE_PROFILE', 'tuned')
+# Number of rendered pages kept in memory and seconds they are valid
+PAGE_CACHE_SIZE = int(os.environ.get('CATALOG_PAGE_CACHE_SIZE', 256))
+PAGE_CACHE_TTL = int(os.environ.get('CATALOG_PAGE_CACHE_TTL', 30))
+# Number of validated login tokens remembered and seconds they are trusted
+TOKEN_CACHE_SIZE = int(os.environ.get('CATALOG_TOKEN_CACHE_SIZE', 1024))
+TOKEN_CACHE_TTL = int(os.environ.get('CATALOG_TOKEN_CACHE_TTL', 300))
+# Requests taking longer than these seconds are logged with their SQL
+# statements, the log is disabled when it is not set
+SLOW_REQUEST_SECONDS = os.environ.get('CATALOG_SLOW_REQUEST_SECONDS')
+# Number of background job worker threads of each process, 0 leaves the
+# jobs to other processes (python jobs.py work)
+JOB_WORKERS = int(os.environ.get('CATALOG_JOB_WORKERS', 2))
+
+# Settings create_app accepts, importing the module only stores them. The
+# database is connected on first use and the schema is never created here,
+# run python models.py for that
+app.config.update(
+    DATABASE_URL=DATABASE_URL,
+    POOL_SIZE=POOL_SIZE,
+    POOL_MAX_OVERFLOW=POOL_MAX_OVERFLOW,
+    POOL_TIMEOUT=POOL_TIMEOUT,
+    SQLITE_PROFILE=SQLITE_PROFILE,
+    SLOW_REQUEST_SECONDS=(
+        float(SLOW_REQUEST_SECONDS) if SLOW_REQUEST_SECONDS else None),
+    JOB_WORKERS=JOB_WORKERS,
+    GOOGLE_SECRETS_FILE=GOOGLE_SECRETS_FILE,
+    FACEBOOK_SECRETS_FILE=FACEBOOK_SECRETS_FILE)
+
+# Settings used to create the engine, they can not change once it exists
+ENGINE_SETTINGS = ('DATABASE_URL', 'POOL_SIZE', 'POOL_MAX_OVERFLOW',
+                   'POOL_TIMEOUT', 'SQLITE_PROFILE')
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def getEngine():
+    """Return the database engine, created by the first caller"""
+    # Preforked workers create it after the fork, so every process gets its
+    # own pool of connections
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                url = app.config['DATABASE_URL']
+                # Pooled SQLite connections are used by several threads,
+                # one at a time. Other drivers do not know the argument
+                connect_args = {}
+                if make_url(url).drivername.startswith('sqlite'):
+                    connect_args['check_same_thread'] = False
+                engine = create_engine(
+                    url,
+                    poolclass=QueuePool,
+                    pool_size=app.config['POOL_SIZE'],
+                    max_overflow=app.config['POOL_MAX_OVERFLOW'],
+                    pool_timeout=app.config['POOL_TIMEOUT'],
+                    connect_args=connect_args)
+                configureSqlite(engine, app.config['SQLITE_PROFILE'])
+                # Duplicated names are only kept out by the unique indexes
+                try:
+                    requireUniqueIndexes(engine)
+                except SchemaError:
+                    engine.dispose()
+                    raise
+                requestMetrics.trackEngine(engine)
+                _engine = engine
+    return _engine
+
+
+DBSession = sessionmaker()
+# Each request (thread) gets its own session, it is removed on teardown so
+# the connection goes back to the pool and no state leaks between requests
+session = scoped_session(lambda: DBSession(bind=getEngine()))
+
+# Categories are few and rarely change so lookups by name or id and the
+# lists used by templates are served from memory. The directory is loaded
+# again whenever the catalog version changes, whatever process wrote, and
+# category write handlers refresh it right after their commit
+categoryDirectory = CategoryDirectory(
+    lambda: session.query(
+        Category.id, Category.name, Category.user_id).order_by(
+        asc(Category.name)).all(),
+    lambda: getCatalogVersion()[0])
+
+# Rendered homepage and category pages, cleared by every catalog write
+pageCache = LRUCache(PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+
+# Identity (profile and user_id) of recently validated provider tokens, so
+# reconnecting with the same token does not call the provider again
+tokenCache = LRUCache(TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL)
+
+# Wall, SQL and template time of every request, exposed on /metrics
+requestMetrics = RequestMetrics(
+    app, slow_seconds=app.config['SLOW_REQUEST_SECONDS'],
+    caches={
+        'category': categoryDirectory,
+        'page': pageCache,
+        'token': tokenCache,
+    })
+requestMetrics.trackProviders(providerHttp)
+
+# Token revocation, category deletes and index rebuilds run in background
+# worker threads, the handlers only queue them. The workers of a process
+# start with its first request or its first queued job
+jobQueue = JobQueue(session, workers=app.config['JOB_WORKERS'],
+                    context=app.app_context, logger=app.logger)
+app.before_first_request(jobQueue.start)
+
+
+def create_app(config=None):
+    """Configure and return the catalog application
+
+    config overrides the settings read from the environment, for example
+    DATABASE_URL, POOL_SIZE, SQLITE_PROFILE, SLOW_REQUEST_SECONDS,
+    JOB_WORKERS, SECRET_KEY or the *_SECRETS_FILE names. The engine is
+    created with the settings in place at the first request, changing one of
+    ENGINE_SETTINGS afterwards raises RuntimeError.
+    """
+    # Routes are registered on the module level app at import so their
+    # endpoint names stay the same, there is one application per process
+    config = config or {}
+    if _engine is not None:
+        changed = sorted(key for key in ENGINE_SETTINGS
+                         if key in config and config[key] != app.config[key])
+        if changed:
+            raise RuntimeError(
+                'The database engine already exists, %s can not be changed'
+                % ', '.join(changed))
+    app.config.update(config)
+    requestMetrics.slow_seconds = app.config['SLOW_REQUEST_SECONDS']
+    jobQueue.workers = app.config['JOB_WORKERS']
+    return app
+
+
+@app.route('/metrics')
+# Request metrics in Prometheus text format
+def showMetrics():
+    return Response(
+        requestMetrics.expose(), mimetype='text/plain; version=0.0.4')
+
+
+# Page size used by the list JSON endpoints when no limit is requested and
+# the largest page a client is allowed to ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Largest number of ids accepted by the multi-get JSON views, all of them
+# are bound parameters of a single IN query
+MAX_MULTIGET_IDS = 500
+# Number of rows read from the database at a time by the streaming export
+EXPORT_BATCH_SIZE = 1000
+# Largest number of operations accepted by the batch write endpoint
+MAX_BATCH_OPERATIONS = 400
+# Number of search results returned when no limit is requested
+SEARCH_PAGE_SIZE = 20
+# Number of catalog items removed per transaction when a category is
+# deleted, other requests can write between two chunks
+DELETE_CHUNK_SIZE = int(os.environ.get('CATALOG_DELETE_CHUNK_SIZE', 1000))
+# Seconds to wait between two chunks, SQLite writers waiting for the lock
+# poll it with sleeps of up to 100ms and would otherwise never get it
+DELETE_CHUNK_PAUSE = float(os.environ.get('CATALOG_DELETE_CHUNK_PAUSE', 0.1))
+
+# The JSON views read plain column tuples instead of ORM objects and encode
+# them with the same keys as the serialize property of each model
+itemSerializer = RowSerializer(CatalogItem.serialize_fields)
+categorySerializer = RowSerializer(Category.serialize_fields)
+userSerializer = RowSerializer(User.serialize_fields)
+searchSerializer = RowSerializer(CatalogItem.serialize_fields + ('category',))
+countSerializer = RowSerializer(('id', 'name', 'item_count'))
+categoryChangeSerializer = RowSerializer(
+    Category.serialize_fields + ('change_seq',))
+itemChangeSerializer = RowSerializer(
+    CatalogItem.serialize_fields + ('change_seq',))
+tombstoneSerializer = RowSerializer(('seq', 'kind', 'id'))
+
+
+@app.teardown_appcontext
+# Release the database session at the end of every request
+def shutdownSession(exception=None):
+    session.remove()
+
+
+def getCatalogVersion():
+    # Current catalog version and the time of the last write. It is read
+    # once per request, conditional and the category directory share it
+    if has_app_context() and 'catalog_version' in g:
+        return g.catalog_version
+    version = session.query(
+        CatalogVersion.version, CatalogVersion.modified).filter_by(
+        id=1).first() or (0, datetime.datetime(1970, 1, 1))
+    if has_app_context():
+        g.catalog_version = version
+    return version
+
+
+def bumpCatalogVersion():
+    # Must be called by every write before its commit so the new version is
+    # stored in the same transaction as the change
+    if has_app_context():
+        g.pop('catalog_version', None)
+    session.query(CatalogVersion).filter_by(id=1).update({
+        CatalogVersion.version: CatalogVersion.version + 1,
+        CatalogVersion.modified: datetime.datetime.utcnow()},
+        synchronize_session=False)
+
+
+def adjustItemCounts(changes):
+    # Update the item counters of categories and users in the current
+    # transaction. changes are (category_id, user_id, delta) tuples, they
+    # are added up so each counter is updated once
+    deltas = {Category: {}, User: {}}
+    for category_id, user_id, delta in changes:
+        deltas[Category][category_id] = deltas[Category].get(
+            category_id, 0) + delta
+        deltas[User][user_id] = deltas[User].get(user_id, 0) + delta
+    for model, counts in deltas.items():
+        for row_id, delta in counts.items():
+            if delta and row_id is not None:
+                session.query(model).filter_by(id=row_id).update(
+                    {model.item_count: model.item_count + delta},
+                    synchronize_session=False)
+
+
+def responseMimetype():
+    # JSON unless the client prefers MessagePack and msgpack is installed
+    if msgpack is None:
+        return 'application/json'
+    return request.accept_mimetypes.best_match(
+        ('application/json',) + MSGPACK_MIMETYPES, 'application/json')
+
+
+def serializedResponse(**payload):
+    # Response of a JSON view in the negotiated format, payload values can
+    # be rows marked with RowSerializer.one or many
+    mimetype = responseMimetype()
+    if mimetype in MSGPACK_MIMETYPES:
+        return Response(encodeMsgpack(payload), mimetype=mimetype)
+    # encodeJSON only knows the default jsonify output
+    if (app.debug or app.config['JSONIFY_PRETTYPRINT_REGULAR'] or
+            not app.config['JSON_SORT_KEYS'] or
+            not app.config['JSON_AS_ASCII']):
+        return jsonify(**toPlain(payload))
+    return Response(
+        encodeJSON(payload), mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+def conditional(view):
+    # Answer conditional GET requests for JSON views: the ETag is derived
+    # from the catalog version so when the client already has the current
+    # version a 304 is returned without running the view
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        version, modified = getCatalogVersion()
+        etag = 'catalog-%d' % version
+        # Each representation has its own ETag
+        if responseMimetype() != 'application/json':
+            etag += '-msgpack'
+        if not is_resource_modified(
+                request.environ, etag=etag, last_modified=modified):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+        response.set_etag(etag)
+        response.last_modified = modified
+        if msgpack is not None:
+            response.vary.add('Accept')
+        return response
+    return decorated
+
+
+def pageKey():
+    # Cache key of the page of the current request. The content only depends
+    # on the route arguments, on whether the user is logged in and on the
+    # catalog version, which changes with every write of any process
+    logged_in = 'username' in login_session
+    return (request.endpoint, tuple(sorted(request.view_args.items())),
+            logged_in, getCatalogVersion()[0])
+
+
+def cachedWholePage():
+    # Whole page cached for anonymous users without flash messages to show,
+    # None if there is none. Views look it up before reading anything else
+    if 'username' in login_session or '_flashes' in login_session:
+        return None
+    return pageCache.get(pageKey() + ('page',))
+
+
+def renderCachedPage(template, renderContent):
+    # The page content is rendered once by renderContent and cached. The
+    # header and flash messages are rendered around it on every request,
+    # except for anonymous users without messages to show that get the
+    # whole page from the cache (see cachedWholePage)
+    key = pageKey()
+    whole_page = ('username' not in login_session and
+                  '_flashes' not in login_session)
+    content = pageCache.get(key)
+    if content is None:
+        content = renderContent()
+        pageCache.set(key, content)
+    page = render_template(template, content=Markup(content))
+    if whole_page:
+        pageCache.set(key + ('page',), page)
+    return page
+
+
+def paginate(query, column):
+    # Keyset pagination on the id column: rows after the 'after' cursor are
+    # returned up to 'limit' together with the cursor of the next page, which
+    # is None on the last page. Passing all=1 returns every row unpaged
+    if request.args.get('all', type=int) == 1:
+        return query.order_by(column).all(), None
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.filter(column > after)
+    # One extra row tells if there is a next page without another query
+    rows = query.order_by(column).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1].id
+    return rows, next_cursor
+
+
+def multiGetResponse(serializer, model, key):
+    # Rows whose id is in the ids argument (ids=3,1,2 or repeated ids
+    # arguments) read with one IN query and returned in the requested order.
+    # Ids that do not exist are listed in 'missing'
+    try:
+        ids = [int(value) for value in
+               ','.join(request.args.getlist('ids')).split(',')
+               if value.strip()]
+    except ValueError:
+        ids = None
+    if ids is None or len(ids) > MAX_MULTIGET_IDS:
+        response = make_response(json.dumps(
+            'ids must be a comma separated list of at most %d ids'
+            % MAX_MULTIGET_IDS), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    # Repeated ids are returned once, at their first position
+    seen = set()
+    ids = [i for i in ids if not (i in seen or seen.add(i))]
+    rows = {}
+    if ids:
+        rows = dict((row.id, row) for row in session.query(
+            *serializer.columns(model)).filter(model.id.in_(ids)))
+    return serializedResponse(**{
+        key: serializer.many([rows[i] for i in ids if i in rows]),
+        'missing': [i for i in ids if i not in rows],
+    })
 
 
 @app.route('/catalog/item/JSON')
+@conditional
 # JSON APIs to view all catalog items
 def catalogItemsJSON():
-    items = session.query(CatalogItem).all()
-    if items:
-        return jsonify(categoryItems=[i.serialize for i in items])
-    return jsonify(categoryItems=[])
+    # ids=3,1,2 returns those catalog items instead of a page
+    if 'ids' in request.args:
+        return multiGetResponse(itemSerializer, CatalogItem, 'categoryItems')
+    items, next_cursor = paginate(
+        session.query(*itemSerializer.columns(CatalogItem)), CatalogItem.id)
+    return serializedResponse(
+        categoryItems=itemSerializer.many(items), next=next_cursor)
+
+
+@app.route('/catalog/item/NDJSON')
+@conditional
+# Stream all catalog items as newline delimited JSON, one item per line
+def catalogItemsNDJSON():
+    columns = itemSerializer.columns(CatalogItem)
+
+    def generate():
+        # Plain column tuples are read in batches after the last id sent so
+        # memory only depends on the batch size, not on the catalog size
+        last_id = 0
+        while True:
+            rows = session.query(*columns).filter(
+                CatalogItem.id > last_id).order_by(CatalogItem.id).limit(
+                EXPORT_BATCH_SIZE).all()
+            if not rows:
+                break
+            lines = [itemSerializer.toJSON(row) for row in rows]
+            last_id = rows[-1].id
+            yield '\n'.join(lines) + '\n'
+
+    return Response(
+        stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @app.route('/catalog/<int:category_id>/item/JSON')
+@conditional
 # JSON APIs to view catalog items for specific category_id
 def categoryIdItemJSON(category_id):
-    items = session.query(CatalogItem).filter_by(
-        category_id=category_id).all()
-    if items:
-        return jsonify(categoryItems=[i.serialize for i in items])
-    return jsonify(categoryItems=[])
+    items, next_cursor = paginate(
+        session.query(*itemSerializer.columns(CatalogItem)).filter(
+            CatalogItem.category_id == category_id),
+        CatalogItem.id)
+    return serializedResponse(
+        categoryItems=itemSerializer.many(items), next=next_cursor)
 
 
 @app.route('/catalog/<string:category_name>/item/JSON')
+@conditional
 # JSON APIs to view catalog items for specific category_name
 def categoryNameItemJSON(category_name):
-    category = session.query(Category).filter_by(name=category_name).first()
+    # Views answering with the catalog version as validator read the
+    # categories from the database, not from the directory
+    category = session.query(Category.id).filter_by(
+        name=category_name).first()
     if category:
-        items = session.query(CatalogItem).filter_by(
-            category_id=category.id).all()
-        if items:
-            return jsonify(categoryItems=[i.serialize for i in items])
-    return jsonify(categoryItems=[])
+        items, next_cursor = paginate(
+            session.query(*itemSerializer.columns(CatalogItem)).filter(
+                CatalogItem.category_id == category.id),
+            CatalogItem.id)
+        return serializedResponse(
+            categoryItems=itemSerializer.many(items), next=next_cursor)
+    return serializedResponse(categoryItems=[], next=None)
 
 
 @app.route('/catalog/<int:category_id>/item/<int:item_id>/JSON')
+@conditional
 # JSON APIs to view specific catalog item data in category_id
 def categoryIdItemIdJSON(category_id, item_id):
-    category = session.query(Category).filter_by(id=category_id).first()
-    if category:
-        item = session.query(CatalogItem).filter_by(
-            category_id=category.id).filter_by(id=item_id).first()
-        if item:
-            return jsonify(category_Item=item.serialize)
-    return jsonify(category_Item=[])
+    item = session.query(*itemSerializer.columns(CatalogItem)).filter(
+        CatalogItem.category_id == category_id,
+        CatalogItem.id == item_id).first()
+    if item:
+        return serializedResponse(category_Item=itemSerializer.one(item))
+    return serializedResponse(category_Item=[])
 
 
 @app.route('/catalog/<string:category_name>/<string:item_title>/JSON')
+@conditional
 # JSON APIs to view specific catalog item data in category_name
 def categoryNameItemNameJSON(category_name, item_title):
-    category = session.query(Category).filter_by(name=category_name).first()
-    if category:
-        item = session.query(CatalogItem).filter_by(
-            category_id=category.id).filter_by(title=item_title).first()
-        if item:
-            return jsonify(category_Item=item.serialize)
-    return jsonify(category_Item=[])
+    item = session.query(*itemSerializer.columns(CatalogItem)).join(
+        Category, CatalogItem.category_id == Category.id).filter(
+        Category.name == category_name,
+        CatalogItem.title == item_title).first()
+    if item:
+        return serializedResponse(category_Item=itemSerializer.one(item))
+    return serializedResponse(category_Item=[])
 
 
 @app.route('/catalog/JSON')
+@conditional
 # JSON APIs to view all categories
 def categoriesJSON():
-    categories = session.query(Category).all()
-    if categories:
-        return jsonify(categories=[r.serialize for r in categories])
-    return jsonify(categories=[])
+    categories, next_cursor = paginate(
+        session.query(*categorySerializer.columns(Category)), Category.id)
+    return serializedResponse(
+        categories=categorySerializer.many(categories), next=next_cursor)
 
 
 @app.route('/catalog/<int:category_id>/JSON')
+@conditional
 # JSON APIs to view specific category by id
 def categoryIdJSON(category_id):
-    category = session.query(Category).filter_by(id=category_id).first()
+    category = session.query(*categorySerializer.columns(Category)).filter(
+        Category.id == category_id).first()
     if category:
-        return jsonify(category=category.serialize)
-    return jsonify(category=[])
+        return serializedResponse(category=categorySerializer.one(category))
+    return serializedResponse(category=[])
 
 
 @app.route('/catalog/<string:category_name>/JSON')
+@conditional
 # JSON APIs to view specific category by name
 def categoryNameJSON(category_name):
-    category = session.query(Category).filter_by(name=category_name).first()
+    category = session.query(*categorySerializer.columns(Category)).filter(
+        Category.name == category_name).first()
     if category:
-        return jsonify(category=category.serialize)
-    return jsonify(category=[])
+        return serializedResponse(category=categorySerializer.one(category))
+    return serializedResponse(category=[])
 
 
 @app.route('/catalog/user/JSON')
+@conditional
 # JSON APIs to view all users
 def catalogUsersJSON():
-    users = session.query(User).all()
-    if users:
-        return jsonify(users=[u.serialize for u in users])
-    return jsonify(users=[])
+    # ids=3,1,2 returns those users instead of a page
+    if 'ids' in request.args:
+        return multiGetResponse(userSerializer, User, 'users')
+    users, next_cursor = paginate(
+        session.query(*userSerializer.columns(User)), User.id)
+    return serializedResponse(
+        users=userSerializer.many(users), next=next_cursor)
 
 
 @app.route('/catalog/user/<int:user_id>/JSON')
+@conditional
 # JSON APIs to view specific user information
 def catalogUserJSON(user_id):
-    user = session.query(User).filter_by(id=user_id).first()
+    user = session.query(*userSerializer.columns(User)).filter(
+        User.id == user_id).first()
     if user:
-        return jsonify(user=user.serialize)
-    return jsonify(user=[])
-
-
-def getCategories(items):
-    # Create an array with category names which will be concatenated to the
-    # catalog items listed in the main view
-    categories_with_items = []
-    for i in items:
-        category = session.query(Category).filter_by(
-            id=i.category_id).first()
-        categories_with_items.append(category.name)
-    return categories_with_items
+        return serializedResponse(user=userSerializer.one(user))
+    return serializedResponse(user=[])
+
+
+@app.route('/catalog/changes/JSON')
+@conditional
+# JSON APIs to view the categories and items changed after a sequence number
+def catalogChangesJSON():
+    # Categories and items inserted or updated after 'since' (with their
+    # change_seq) and the tombstones of the deleted ones. At most 'limit'
+    # changes are returned, the oldest first; 'next' is the 'since' of the
+    # following call and 'more' tells if there are changes left
+    since = request.args.get('since', 0, type=int)
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    categories = session.query(
+        *categoryChangeSerializer.columns(Category)).filter(
+        Category.change_seq > since).order_by(
+        Category.change_seq).limit(limit + 1).all()
+    items = session.query(*itemChangeSerializer.columns(CatalogItem)).filter(
+        CatalogItem.change_seq > since).order_by(
+        CatalogItem.change_seq).limit(limit + 1).all()
+    deleted = session.query(
+        Tombstone.seq, Tombstone.kind, Tombstone.record_id).filter(
+        Tombstone.seq > since).order_by(Tombstone.seq).limit(limit + 1).all()
+    # Keep the first 'limit' changes of the three lists together
+    seqs = sorted([row.change_seq for row in categories] +
+                  [row.change_seq for row in items] +
+                  [row.seq for row in deleted])
+    more = len(seqs) > limit
+    last = seqs[min(limit, len(seqs)) - 1] if seqs else since
+    return serializedResponse(
+        categories=categoryChangeSerializer.many(
+            [row for row in categories if row.change_seq <= last]),
+        items=itemChangeSerializer.many(
+            [row for row in items if row.change_seq <= last]),
+        deleted=tombstoneSerializer.many(
+            [row for row in deleted if row.seq <= last]),
+        next=last, more=more)
+
+
+@app.route('/catalog/stats/JSON')
+@conditional
+# JSON APIs to view the number of catalog items per category and per user
+def catalogStatsJSON():
+    # Counters are stored with each category and user, nothing is counted
+    categories = session.query(
+        Category.id, Category.name, Category.item_count).order_by(
+        Category.id).all()
+    users = session.query(User.id, User.name, User.item_count).order_by(
+        User.id).all()
+    return serializedResponse(
+        categories=countSerializer.many(categories),
+        users=countSerializer.many(users),
+        total_categories=len(categories),
+        total_users=len(users),
+        total_items=sum(category.item_count for category in categories))
+
+
+@app.route('/catalog/job/<int:job_id>/JSON')
+# JSON APIs to view the status of a background job
+def jobJSON(job_id):
+    # Not conditional, the catalog version does not change with the job.
+    # Jobs are only shown to the logged in user who queued them
+    job = session.query(Job).filter_by(id=job_id).first()
+    # Google logout leaves user_id in the session, only a logged in user
+    # sees its jobs
+    if job and job.user_id is not None and 'username' in login_session \
+            and job.user_id == login_session.get('user_id'):
+        return serializedResponse(job=job.serialize)
+    return serializedResponse(job=[])
 
 
 @app.route('/')
 @app.route('/catalog')
 # Show all categories with the latest 10 catalog items added
 def showCategories():
-    categories = session.query(Category).order_by(asc(Category.name))
-    items = session.query(CatalogItem).order_by(
-        CatalogItem.id.desc()).limit(10).all()
-    # Get the category names which will be concatenated to each catalog item
-    categories_with_items = getCategories(items=items)
+    page = cachedWholePage()
+    if page is not None:
+        return page
+    categories = categoryDirectory.all()
     # Check if database is empty
-    if not session.query(Category).first():
+    if not categories:
         flash('No categories found .. database empty')
         if 'username' not in login_session:
             flash('Users can add categories only if logged in .. Please login ')
-    # Categories will be listed on the first column of the table,
-    # items will be concatenaded with categories_with_items and listed
-    # in the second column
+
+    def renderContent():
+        # Latest items are fetched together with their category name in a
+        # single joined query instead of one category lookup per item
+        latest = session.query(CatalogItem, Category.name).options(
+            *CatalogItem.loadProfile('list')).join(
+            Category, CatalogItem.category_id == Category.id).order_by(
+            CatalogItem.id.desc()).limit(10).all()
+        items = [item for item, category_name in latest]
+        # Category names which will be concatenated to each catalog item
+        categories_with_items = [
+            category_name for item, category_name in latest]
+        # Categories will be listed on the first column of the table,
+        # items will be concatenaded with categories_with_items and listed
+        # in the second column
+        return render_template(
+            'catalogContent.html', categories=categories, items=items,
+            categories_with_items=categories_with_items)
+
+    return renderCachedPage('catalog.html', renderContent)
+
+
+# Catalog items matching the full text query ordered by relevance, with
+# the name of their category
+SEARCH_SQL = text(
+    "SELECT category_item.title, category_item.description, "
+    "category_item.id, category_item.user_id, category_item.category_id, "
+    "category.name AS category "
+    "FROM category_item_fts "
+    "JOIN category_item ON category_item.id = category_item_fts.rowid "
+    "JOIN category ON category.id = category_item.category_id "
+    "WHERE category_item_fts MATCH :query "
+    "ORDER BY category_item_fts.rank LIMIT :limit OFFSET :offset")
+
+
+def searchItems(terms):
+    # Every word typed by the user is quoted so FTS5 operators in it are
+    # matched literally, the last one also matches as a prefix. Results
+    # are paginated with 'limit' and 'offset', 'next' is the offset of the
+    # following page or None on the last page
+    words = ['"%s"' % word.replace('"', '""') for word in terms.split()]
+    if not words:
+        return [], None
+    words[-1] += '*'
+    limit = request.args.get('limit', SEARCH_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    rows = session.execute(SEARCH_SQL, {
+        'query': ' '.join(words), 'limit': limit + 1, 'offset': offset,
+    }).fetchall()
+    next_offset = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_offset = offset + limit
+    return rows, next_offset
+
+
+@app.route('/search/JSON')
+@conditional
+# JSON APIs to search catalog items by title and description
+def searchJSON():
+    items, next_offset = searchItems(request.args.get('q', ''))
+    return serializedResponse(
+        categoryItems=searchSerializer.many(items), next=next_offset)
+
+
+@app.route('/search')
+# Show catalog items matching the search terms
+def showSearch():
+    terms = request.args.get('q', '')
+    items, next_offset = searchItems(terms)
     return render_template(
-        'catalog.html', categories=categories, items=items,
-        categories_with_items=categories_with_items)
+        'search.html', terms=terms, items=items, next_offset=next_offset)
 
 
 @app.route('/catalog/new', methods=['GET', 'POST'])
@@ -175,17 +720,22 @@ def newCategory():
         flash('In order to add a new category you must log in')
         return redirect('/login')
     if request.method == 'POST':
-        # Veriry that category name is not already in database
-        name = request.form['name']
-        if session.query(Category).filter_by(name=name).first():
+        # The unique index on the name rejects a category name already in
+        # database, even one added meanwhile by another request
+        newCategory = Category(
+            name=request.form['name'],
+            user_id=login_session['user_id'])
+        try:
+            session.add(newCategory)
+            bumpCatalogVersion()
+            session.commit()
+        except IntegrityError:
+            session.rollback()
             flash('Category name already exist .. record not added')
         else:
-            newCategory = Category(
-                name=request.form['name'],
-                user_id=login_session['user_id'])
-            session.add(newCategory)
             flash('New Category %s Successfully Created' % newCategory.name)
-            session.commit()
+            categoryDirectory.refresh()
+            pageCache.clear()
         return redirect(url_for('showCategories'))
     if request.method == 'GET':
         return render_template('newCategory.html')
@@ -206,20 +756,21 @@ def editCategory(category_name):
         if editedCategory.user_id == login_session['user_id']:
             if request.method == 'POST':
                 if request.form['name']:
-                    # add the record only if the new name is not already
-                    # in database
+                    # The record is only updated if the new name is not
+                    # already in database, the unique index checks it
                     name = request.form['name']
-                    if session.query(Category).filter(
-                            id != editedCategory.id).filter_by(
-                                name=name).first():
+                    try:
+                        editedCategory.name = name
+                        bumpCatalogVersion()
+                        session.commit()
+                    except IntegrityError:
+                        session.rollback()
                         flash('Category name already exist .. \
                             record not updated')
                     else:
-                        editedCategory.name = request.form['name']
-                        session.commit()
-                        flash(
-                            'Category successfully edited %s'
-                            % editedCategory.name)
+                        categoryDirectory.refresh()
+                        pageCache.clear()
+                        flash('Category successfully edited %s' % name)
             if request.method == 'GET':
                 return render_template(
                     'editCategory.html',
@@ -247,11 +798,14 @@ def deleteCategory(category_name):
         # If user is the owner then he is allowed to delete this item
         if categoryToDelete.user_id == login_session['user_id']:
             if request.method == 'POST':
-                session.delete(categoryToDelete)
-                session.query(CatalogItem).filter_by(
-                    category_id=categoryToDelete.id).delete()
-                flash('%s Successfully Deleted' % categoryToDelete.name)
-                session.commit()
+                # Large categories take a while, the items are deleted by a
+                # background job
+                job_id = jobQueue.enqueue(
+                    'delete_category', {'category_id': categoryToDelete.id},
+                    user_id=login_session['user_id'])
+                flash('%s is being deleted, follow the progress at %s'
+                      % (categoryToDelete.name,
+                         url_for('jobJSON', job_id=job_id)))
             if request.method == 'GET':
                 return render_template(
                     'deleteCategory.html',
@@ -265,15 +819,83 @@ def deleteCategory(category_name):
     return redirect(url_for('showCategories'))
 
 
+def deleteCategoryInChunks(category_id, progress=None):
+    """Delete a category and its items, return the number of items deleted
+
+    Items are deleted DELETE_CHUNK_SIZE at a time, each chunk in its own
+    transaction, so readers and other writers are only held back for one
+    chunk. progress is called with the number of items deleted so far after
+    every chunk.
+    """
+    deleted = 0
+    while True:
+        # Bumping the version first takes the write lock, so the chunk can
+        # not change between reading and deleting it
+        bumpCatalogVersion()
+        ids = [item_id for (item_id,) in session.query(
+            CatalogItem.id).filter_by(category_id=category_id).order_by(
+            CatalogItem.id).limit(DELETE_CHUNK_SIZE)]
+        if ids:
+            # Owners of the deleted items lose them from their counters
+            owners = session.query(
+                CatalogItem.user_id, func.count(CatalogItem.id)).filter(
+                CatalogItem.id.in_(ids)).group_by(CatalogItem.user_id).all()
+            adjustItemCounts([(category_id, user_id, -count)
+                              for user_id, count in owners])
+            # The items are deleted in bulk, without the ORM
+            addTombstones(session, 'item', ids)
+            session.query(CatalogItem).filter(
+                CatalogItem.id.in_(ids)).delete(synchronize_session=False)
+            deleted += len(ids)
+        last = len(ids) < DELETE_CHUNK_SIZE
+        if last:
+            # The category goes with the last chunk, no item can be added
+            # to it meanwhile
+            category = session.query(Category).get(category_id)
+            if category:
+                session.delete(category)
+        session.commit()
+        pageCache.clear()
+        if progress:
+            progress(deleted)
+        else:
+            app.logger.info(
+                'Category %d: %d catalog items deleted', category_id, deleted)
+        if last:
+            categoryDirectory.refresh()
+            return deleted
+        time.sleep(DELETE_CHUNK_PAUSE)
+
+
+@jobQueue.register('delete_category')
+# Background job deleting a category and its catalog items
+def deleteCategoryJob(args, progress):
+    return {'deleted': deleteCategoryInChunks(args['category_id'], progress)}
+
+
+@jobQueue.register('rebuild_search_index')
+# Background job indexing every catalog item again for the search
+def rebuildSearchIndexJob(args, progress):
+    rebuildSearchIndex(getEngine())
+    pageCache.clear()
+
+
+@jobQueue.register('repair_item_counts')
+# Background job recounting the items of every category and user
+def repairItemCountsJob(args, progress):
+    return {'fixed': repairItemCounts(getEngine())}
+
+
 @app.route('/catalog/<category_name>/<item_title>')
 # Show specific catalog item details
 def showCatalogItemDetails(category_name, item_title):
-    category = session.query(Category).filter_by(name=category_name).first()
+    category = categoryDirectory.byName(category_name)
     if category:
         # Look for the item title in above category
-        item = session.query(CatalogItem).filter_by(
+        item = session.query(CatalogItem).options(
+            *CatalogItem.loadProfile('detail')).filter_by(
             category_id=category.id).filter_by(title=item_title).first()
-        categories = session.query(Category)
+        categories = categoryDirectory.all()
         return render_template(
             'catalogItem.html', category_name=category_name,
             item=item, categories=categories)
@@ -285,12 +907,20 @@ def showCatalogItemDetails(category_name, item_title):
 @app.route('/catalog/<category_name>')
 # Show catalog items for a specific category
 def showCatalogItem(category_name):
-    category = session.query(Category).filter_by(name=category_name).first()
+    page = cachedWholePage()
+    if page is not None:
+        return page
+    category = categoryDirectory.byName(category_name)
     if category:
-        items = session.query(CatalogItem).filter_by(
-            category_id=category.id).all()
-        return render_template(
-            'categoryCatalogItem.html', items=items, category=category)
+        def renderContent():
+            items = session.query(CatalogItem).options(
+                *CatalogItem.loadProfile('list')).filter_by(
+                category_id=category.id).all()
+            return render_template(
+                'categoryCatalogItemContent.html', items=items,
+                category=category)
+
+        return renderCachedPage('categoryCatalogItem.html', renderContent)
     else:
         flash('Category was not found...')
         return redirect(url_for('showCategories'))
@@ -303,26 +933,29 @@ def newCatalogItem():
     if 'username' not in login_session:
         flash('In order to add a new catalog item you must log in')
         return redirect('/login')
-    categories = session.query(Category)
+    categories = categoryDirectory.all()
     if categories:
         if request.method == 'POST':
-            category = session.query(Category).filter_by(
-                name=request.form['category']).first()
+            category = categoryDirectory.byName(request.form['category'])
             if category:
-                # Add a new item only if title does not exist
-                if session.query(CatalogItem).filter_by(
-                        category_id=category.id).filter_by(
-                        title=request.form['title']).first():
+                # Add a new item only if title does not exist in the
+                # category, the unique index on both checks it
+                newItem = CatalogItem(
+                    title=request.form['title'],
+                    description=request.form['description'],
+                    category_id=category.id,
+                    user_id=login_session['user_id'])
+                try:
+                    session.add(newItem)
+                    adjustItemCounts([(category.id, newItem.user_id, 1)])
+                    bumpCatalogVersion()
+                    session.commit()
+                except IntegrityError:
+                    session.rollback()
                     flash('Catalog item description already exist in this \
                         category.. record not updated')
                 else:
-                    newItem = CatalogItem(
-                        title=request.form['title'],
-                        description=request.form['description'],
-                        category_id=category.id,
-                        user_id=login_session['user_id'])
-                    session.add(newItem)
-                    session.commit()
+                    pageCache.clear()
                     flash(
                         'New Catalog Item: %s Successfully Created'
                         % (newItem.title))
@@ -347,37 +980,44 @@ def editCatalogItem(category_name, item_title):
         flash('In order to edit a catalog item you must log in')
         return redirect('/login')
     # Get the catalog item to be edited
-    category = session.query(Category).filter_by(name=category_name).first()
+    category = categoryDirectory.byName(category_name)
     if category:
         editedItem = session.query(CatalogItem).filter_by(
             category_id=category.id).filter_by(title=item_title).first()
         # Get the categories so they are displayed in a list of options
         if editedItem:
-            categories = session.query(Category)
+            categories = categoryDirectory.all()
             if categories:
                 # If user is the owner then he is allowed to edit this item
                 if editedItem.user_id == login_session['user_id']:
                     if request.method == 'POST':
                         if request.form['category']:
-                            category = session.query(Category).filter_by(
-                                name=request.form['category']).first()
-                        # Edit item only if title is not already in database
-                        if session.query(CatalogItem).filter_by(
-                                category_id=category.id).filter(
-                                id != editedItem.id).filter_by(
-                                title=request.form['title']).first():
-                            flash('Catalog item title already exist in this \
-                                category.. record not updated')
-                        else:
+                            category = categoryDirectory.byName(
+                                request.form['category'])
+                        # Edit item only if title is not already in the
+                        # category, the unique index on both checks it
+                        try:
                             if request.form['title']:
                                 editedItem.title = request.form['title']
                             if request.form['description']:
                                 editedItem.description = request.form[
                                     'description']
-                            if request.form['category']:
+                            if request.form['category'] and \
+                                    editedItem.category_id != category.id:
+                                adjustItemCounts([
+                                    (editedItem.category_id,
+                                     editedItem.user_id, -1),
+                                    (category.id, editedItem.user_id, 1)])
                                 editedItem.category_id = category.id
                             session.add(editedItem)
+                            bumpCatalogVersion()
                             session.commit()
+                        except IntegrityError:
+                            session.rollback()
+                            flash('Catalog item title already exist in this \
+                                category.. record not updated')
+                        else:
+                            pageCache.clear()
                             flash('Catalog Item Successfully Edited')
                     if request.method == 'GET':
                         return render_template(
@@ -411,20 +1051,24 @@ def deleteCatalogItem(category_name, item_title):
         flash('In order to delete a catalog item you must log in')
         return redirect('/login')
     # Get the catalog item to be deleted
-    category = session.query(Category).filter_by(name=category_name).first()
+    category = categoryDirectory.byName(category_name)
     if category:
         itemToDelete = session.query(CatalogItem).filter_by(
             category_id=category.id).filter_by(title=item_title).first()
         if itemToDelete:
             # Get the categories so they are displayed in a list of options
-            categories = session.query(Category)
+            categories = categoryDirectory.all()
             if categories:
                 # If user is the owner then he is allowed to delete this item
                 if itemToDelete.user_id == login_session['user_id']:
                     if request.method == 'POST':
                         category_id = itemToDelete.category_id
+                        adjustItemCounts(
+                            [(category_id, itemToDelete.user_id, -1)])
                         session.delete(itemToDelete)
+                        bumpCatalogVersion()
                         session.commit()
+                        pageCache.clear()
                         flash('Category Item Successfully Deleted')
                     if request.method == 'GET':
                         return render_template(
@@ -445,6 +1089,170 @@ def deleteCatalogItem(category_name, item_title):
     return redirect(url_for('showCategories'))
 
 
+def batchOperationError(op):
+    # Error of a batch operation whose fields have the wrong type, or None
+    for field in ('id', 'category_id'):
+        value = op.get(field)
+        if value is not None and (not isinstance(value, numbers.Integral) or
+                                  isinstance(value, bool)):
+            return '%s must be an integer' % field
+    for field in ('title', 'description', 'category'):
+        value = op.get(field)
+        if value is not None and not isinstance(value, string_types):
+            return '%s must be a string' % field
+    return None
+
+
+@app.route('/catalog/item/batch/JSON', methods=['POST'])
+# Create, update and delete many catalog items in a single transaction
+def catalogItemsBatchJSON():
+    if 'username' not in login_session:
+        response = make_response(
+            json.dumps('In order to change catalog items you must log in'),
+            401)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or \
+            len(operations) > MAX_BATCH_OPERATIONS:
+        response = make_response(json.dumps(
+            'operations must be a list of at most %d operations'
+            % MAX_BATCH_OPERATIONS), 400)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    operations = [op if isinstance(op, dict) else {} for op in operations]
+    # Operations with fields of the wrong type only get an error, they are
+    # left out of the lookups below
+    errors = [batchOperationError(op) for op in operations]
+    valid = [op for op, error in zip(operations, errors) if not error]
+    user_id = login_session['user_id']
+
+    def getCategory(op):
+        # Operations refer to categories by name or by id
+        if op.get('category'):
+            return categoryDirectory.byName(op['category'])
+        if op.get('category_id') is not None:
+            return categoryDirectory.byId(op['category_id'])
+
+    # Items to update or delete and the items that could have the same
+    # title in the same category are read with one query each
+    ids = set(op.get('id') for op in valid
+              if op.get('op') in ('update', 'delete'))
+    items = {}
+    if ids:
+        items = dict((item.id, item) for item in session.query(
+            CatalogItem).filter(CatalogItem.id.in_(ids)))
+    category_ids = set(item.category_id for item in items.values())
+    titles = set(item.title for item in items.values())
+    for op in valid:
+        category = getCategory(op)
+        if category:
+            category_ids.add(category.id)
+        if op.get('title'):
+            titles.add(op['title'])
+    taken = {}
+    if category_ids and titles:
+        taken = dict(((category_id, title), item_id) for
+                     item_id, category_id, title in session.query(
+                         CatalogItem.id, CatalogItem.category_id,
+                         CatalogItem.title).filter(
+                         CatalogItem.category_id.in_(category_ids)).filter(
+                         CatalogItem.title.in_(titles)))
+
+    results = []
+    created = []
+    counts = []
+    try:
+        for index, op in enumerate(operations):
+            action = op.get('op')
+            result = {'index': index, 'op': action}
+            results.append(result)
+            if errors[index]:
+                result['error'] = errors[index]
+                continue
+            if action == 'create':
+                category = getCategory(op)
+                if not op.get('title'):
+                    result['error'] = 'title is required'
+                elif not category:
+                    result['error'] = 'category was not found'
+                elif (category.id, op['title']) in taken:
+                    result['error'] = 'title already exist in this category'
+                else:
+                    newItem = CatalogItem(
+                        title=op['title'],
+                        description=op.get('description'),
+                        category_id=category.id,
+                        user_id=user_id)
+                    session.add(newItem)
+                    taken[(category.id, newItem.title)] = None
+                    created.append((result, newItem))
+                    counts.append((category.id, user_id, 1))
+                    result['status'] = 'created'
+                continue
+            if action not in ('update', 'delete'):
+                result['error'] = 'op must be create, update or delete'
+                continue
+            item = items.get(op.get('id'))
+            result['id'] = op.get('id')
+            if not item:
+                result['error'] = 'item was not found'
+            elif item.user_id != user_id:
+                result['error'] = 'you are not the owner of this item'
+            elif action == 'delete':
+                session.delete(item)
+                # Changes are flushed in the order of the operations so the
+                # unique title index never sees an intermediate state
+                session.flush()
+                del items[item.id]
+                taken.pop((item.category_id, item.title), None)
+                counts.append((item.category_id, user_id, -1))
+                result['status'] = 'deleted'
+            else:
+                category_id = item.category_id
+                if op.get('category') or op.get('category_id') is not None:
+                    category = getCategory(op)
+                    if not category:
+                        result['error'] = 'category was not found'
+                        continue
+                    category_id = category.id
+                title = op.get('title') or item.title
+                key = (category_id, title)
+                if key in taken and taken[key] != item.id:
+                    result['error'] = 'title already exist in this category'
+                    continue
+                taken.pop((item.category_id, item.title), None)
+                taken[key] = item.id
+                if category_id != item.category_id:
+                    counts.extend([(item.category_id, user_id, -1),
+                                   (category_id, user_id, 1)])
+                item.title = title
+                item.category_id = category_id
+                if op.get('description'):
+                    item.description = op['description']
+                session.flush()
+                result['status'] = 'updated'
+        if any('status' in result for result in results):
+            session.flush()
+            for result, newItem in created:
+                result['id'] = newItem.id
+            adjustItemCounts(counts)
+            bumpCatalogVersion()
+            session.commit()
+            pageCache.clear()
+    except IntegrityError:
+        # Another request wrote a conflicting title meanwhile, nothing
+        # of this batch is applied
+        session.rollback()
+        response = make_response(json.dumps(
+            'A conflicting change was made meanwhile, batch not applied'),
+            409)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+    return jsonify(results=results)
+
+
 @app.route('/login')
 # Create anti-forgery state token to login user with a third party system
 def showLogin():
@@ -461,59 +1269,47 @@ def fbconnect():
         response = make_response(json.dumps('Invalid state parameter.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    access_token = request.data
+    access_token = request.data.decode('utf-8')
     print "access token received %s " % access_token
-    app_id = json.loads(open('fb_client_secrets.json', 'r').read())[
-        'web']['app_id']
-    app_secret = json.loads(
-        open('fb_client_secrets.json', 'r').read())['web']['app_secret']
-    url = 'https://graph.facebook.com/oauth/access_token?grant_type=\
-        fb_exchange_token&client_id=%s&client_secret=%s\
-        &fb_exchange_token=%s' % (app_id, app_secret, access_token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    # Use token to get user info from API
-    userinfo_url = "https://graph.facebook.com/v2.8/me"
-    '''
-        Due to the formatting for the result from the server token exchange
-        we have to split the token first on commas and select the first index
-        which gives us the key : value for the server access token then we
-        split it on colons to pull out the actual token value and replace the
-        remaining quotes with nothing so that it can be used directly in the
-        graph api calls
-    '''
-    token = result.split(',')[0].split(':')[1].replace('"', '')
-    url = 'https://graph.facebook.com/v2.8/me?access_token=%s\
-        &fields=name,id,email' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    # print "url sent for API access:%s"% url
-    # print "API JSON result: %s" % result
-    data = json.loads(result)
+    # A token already validated recently (page reload, several tabs) is
+    # resolved from the cache without calling facebook or the database
+    token_key = tokenKey('facebook', access_token)
+    identity = tokenCache.get(token_key)
+    if identity is None:
+        try:
+            # Exchange the client token for a long lived server token and
+            # use it to get user info from API
+            secrets = loadSecrets(app.config['FACEBOOK_SECRETS_FILE'])
+            token = facebookExchangeToken(access_token, secrets)
+            data = facebookUserInfo(token)
+            picture = facebookPicture(token)
+        except (ProviderError, KeyError) as err:
+            response = make_response(
+                json.dumps('Failed to get user info from facebook.'), 401)
+            # Error messages can quote the tokens, only their type is logged
+            app.logger.warning('Facebook login failed: %s',
+                               type(err).__name__)
+            response.headers['Content-Type'] = 'application/json'
+            return response
+        identity = {
+            'username': data["name"],
+            'email': data["email"],
+            'facebook_id': data["id"],
+            # The token must be stored in the login_session in order to
+            # properly logout
+            'access_token': token,
+            'picture': picture,
+        }
+        # See if user exists
+        user_id = getUserID(identity['email'])
+        # If user does not exist in database then it is inserted
+        if not user_id:
+            user_id = createUser(identity)
+        identity['user_id'] = user_id
+        tokenCache.set(token_key, identity)
     login_session['provider'] = 'facebook'
-    login_session['username'] = data["name"]
-    login_session['email'] = data["email"]
-    login_session['facebook_id'] = data["id"]
-
-    # The token must be stored in the login_session in order to
-    # properly logout
-    login_session['access_token'] = token
-
-    # Get user picture
-    url = 'https://graph.facebook.com/v2.8/me/picture?access_token=%s\
-        &redirect=0&height=200&width=200' % token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-
-    login_session['picture'] = data["data"]["url"]
-
-    # See if user exists
-    user_id = getUserID(login_session['email'])
-    # If user does not exist in database then it is inserted
-    if not user_id:
-        user_id = createUser(login_session)
-    login_session['user_id'] = user_id
+    login_session['token_keys'] = [token_key]
+    login_session.update(identity)
 
     output = ''
     output += '<h1>Welcome, '
@@ -535,10 +1331,11 @@ def fbdisconnect():
     facebook_id = login_session['facebook_id']
     # The access token must me included to successfully logout
     access_token = login_session['access_token']
-    url = 'https://graph.facebook.com/%s/permissions?access_token=%s' \
-        % (facebook_id, access_token)
-    h = httplib2.Http()
-    result = h.request(url, 'DELETE')[1]
+    evictTokens()
+    # The permissions are revoked by a background job
+    jobQueue.enqueue('revoke_facebook', {
+        'facebook_id': facebook_id, 'access_token': access_token},
+        user_id=login_session.get('user_id'))
     return "you have been logged out"
 
 
@@ -551,26 +1348,68 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
     # Obtain authorization code
-    code = request.data
-
+    code = request.data.decode('utf-8')
+    secrets = loadSecrets(app.config['GOOGLE_SECRETS_FILE'])
     try:
-        # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets(
-            'client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+        # Upgrade the authorization code into an access token. Codes are
+        # single use, google checks it on every exchange so it is never
+        # answered from the cache
+        access_token, id_token = exchangeGoogleCode(code, secrets)
+    except ProviderError:
         response = make_response(
             json.dumps('Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
+    # Google issues a new access token for every code, so a user validated
+    # recently (page reload, several tabs) is found in the cache by the
+    # google id of the exchanged id token, without calling google again or
+    # the database
+    token_key = tokenKey('google', id_token.get('sub'))
+    identity = tokenCache.get(token_key)
+    if identity is None:
+        identity = validateGoogleToken(access_token, id_token, secrets)
+        # A response means the token was rejected
+        if not isinstance(identity, dict):
+            return identity
+        tokenCache.set(token_key, identity)
+    else:
+        # The new token is the one revoked at logout
+        identity = dict(identity, access_token=access_token)
+
+    stored_access_token = login_session.get('access_token')
+    stored_gplus_id = login_session.get('gplus_id')
+    if stored_access_token is not None and \
+            identity['gplus_id'] == stored_gplus_id:
+        response = make_response(
+            json.dumps('Current user is already connected.'), 200)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+    # Store the access token in the session for later use.
+    login_session.update(identity)
+    login_session['provider'] = 'google'
+    login_session['token_keys'] = [token_key]
+    output = ''
+    output += '<h1>Welcome, '
+    output += login_session['username']
+    output += '!</h1>'
+    output += '<img src = "'
+    output += login_session['picture']
+    output += ' " style="width: 300px; height: 300px;border-radius: 150px;\
+        -webkit-border-radius: 150px;-moz-border-radius: 150px;"> '
+    flash("you are now logged in as %s" % login_session['username'])
+    print "done!"
+    return output
+
 
+def validateGoogleToken(access_token, id_token, secrets):
+    # Return the identity of the google user owning the access token or an
+    # error response if the token is not valid for this app
     # Check that the access token is valid.
-    access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    try:
+        result = googleTokenInfo(access_token)
+    except ProviderError as err:
+        return googleUnreachable(err)
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
         response = make_response(json.dumps(result.get('error')), 500)
@@ -578,70 +1417,78 @@ def gconnect():
         return response
 
     # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
-    if result['user_id'] != gplus_id:
+    gplus_id = id_token.get('sub')
+    if result.get('user_id') != gplus_id:
         response = make_response(
             json.dumps("Token's user ID doesn't match given user ID."), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
 
     # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    if result.get('issued_to') != secrets['client_id']:
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         print "Token's client ID does not match app's."
         response.headers['Content-Type'] = 'application/json'
         return response
 
-    stored_access_token = login_session.get('access_token')
-    stored_gplus_id = login_session.get('gplus_id')
-    if stored_access_token is not None and gplus_id == stored_gplus_id:
-        response = make_response(
-            json.dumps('Current user is already connected.'), 200)
-        response.headers['Content-Type'] = 'application/json'
-        return response
+    # Get user info
+    try:
+        data = googleUserInfo(access_token)
+    except ProviderError as err:
+        return googleUnreachable(err)
+
+    identity = {
+        'access_token': access_token,
+        'gplus_id': gplus_id,
+        'username': data['name'],
+        'picture': data['picture'],
+        'email': data['email'],
+    }
+    # See if user exists, if it doesn't make a new one
+    user_id = getUserID(identity['email'])
+    # If user does not exist then insert it to the database
+    if not user_id:
+        user_id = createUser(identity)
+    identity['user_id'] = user_id
+    return identity
 
-    # Store the access token in the session for later use.
-    login_session['access_token'] = credentials.access_token
-    login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
+def googleUnreachable(err):
+    # Error response when google can not be asked about a token, the error
+    # messages can quote the token so only their type is logged
+    app.logger.warning('Google token validation failed: %s',
+                       type(err).__name__)
+    response = make_response(
+        json.dumps('Failed to validate the token with google.'), 500)
+    response.headers['Content-Type'] = 'application/json'
+    return response
 
-    data = answer.json()
 
-    login_session['username'] = data['name']
-    login_session['picture'] = data['picture']
-    login_session['email'] = data['email']
-    login_session['provider'] = 'google'
+def tokenKey(provider, token):
+    # Tokens are kept in the cache by their hash, never in clear
+    return hashlib.sha256(
+        ('%s:%s' % (provider, token)).encode('utf-8')).hexdigest()
 
-    # See if user exists, if it doesn't make a new one
-    user_id = getUserID(login_session['email'])
-    # If user does not exist then insert it to the database
-    if not user_id:
-        user_id = createUser(login_session)
-    login_session['user_id'] = user_id
-    output = ''
-    output += '<h1>Welcome, '
-    output += login_session['username']
-    output += '!</h1>'
-    output += '<img src = "'
-    output += login_session['picture']
-    output += ' " style="width: 300px; height: 300px;border-radius: 150px;\
-        -webkit-border-radius: 150px;-moz-border-radius: 150px;"> '
-    flash("you are now logged in as %s" % login_session['username'])
-    print "done!"
-    return output
+
+def evictTokens():
+    # Forget the cached identity of the tokens used by the logged in user
+    for key in login_session.pop('token_keys', []):
+        tokenCache.pop(key)
 
 
 def createUser(login_session):
     # add user to the database
     newUser = User(name=login_session['username'], email=login_session[
                    'email'], picture=login_session['picture'])
-    session.add(newUser)
-    session.commit()
+    try:
+        session.add(newUser)
+        bumpCatalogVersion()
+        session.commit()
+    except IntegrityError:
+        # The unique index on the email rejects a user created meanwhile by
+        # a concurrent first login, that user is the one logging in
+        session.rollback()
     user = session.query(User).filter_by(email=login_session['email']).one()
     return user.id
 
@@ -668,29 +1515,36 @@ def gdisconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
     print 'In gdisconnect access token is %s', access_token
+    evictTokens()
     print 'User name is: '
     print login_session['username']
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' \
-        % login_session['access_token']
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-    print 'result is '
-    print result
-    if result['status'] == '200':
-        del login_session['access_token']
-        del login_session['gplus_id']
-        del login_session['username']
-        del login_session['email']
-        del login_session['picture']
-        response = make_response(
-                json.dumps('Successfully disconnected.'), 200)
-        response.headers['Content-Type'] = 'application/json'
-        return response
-    else:
-        response = make_response(
-            json.dumps('Failed to revoke token for given user.', 400))
-        response.headers['Content-Type'] = 'application/json'
-        return response
+    # The token is revoked by a background job, the user is logged out
+    # without waiting for google
+    jobQueue.enqueue('revoke_google', {'access_token': access_token},
+                     user_id=login_session.get('user_id'))
+    del login_session['access_token']
+    del login_session['gplus_id']
+    del login_session['username']
+    del login_session['email']
+    del login_session['picture']
+    response = make_response(
+            json.dumps('Successfully disconnected.'), 200)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+@jobQueue.register('revoke_google', sensitive=True)
+# Background job revoking the token of a google user who logged out
+def revokeGoogleJob(args, progress):
+    if not googleRevoke(args['access_token']):
+        raise ProviderError('Failed to revoke token for given user.')
+
+
+@jobQueue.register('revoke_facebook', sensitive=True)
+# Background job revoking the permissions of a facebook user who logged out
+def revokeFacebookJob(args, progress):
+    if not facebookRevoke(args['facebook_id'], args['access_token']):
+        raise ProviderError('Failed to revoke permissions for given user.')
 
 
 @app.route('/disconnect')
@@ -717,6 +1571,6 @@ def disconnect():
 
 
 if __name__ == '__main__':
-    app.secret_key = 'super_secret_key'
+    create_app({'SECRET_KEY': 'super_secret_key'})
     app.debug = True
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Background jobs run by worker threads outside of the requests
+
+Usage:
+    python jobs.py work --workers 2
+    python jobs.py enqueue rebuild_search_index
+
+Jobs are rows of the job table, so they survive restarts and can be queued
+by any process sharing the database. The web application runs its own
+workers (CATALOG_JOB_WORKERS), 'work' runs them without the web server.
+"""
+from sqlalchemy import and_, or_
+
+from models import Job
+
+import argparse
+import atexit
+import datetime
+import json
+import logging
+import sys
+import threading
+import time
+
+
+class JobQueue(object):
+    """Queue of background jobs stored in the job table
+
+    Handlers are registered per kind of job. enqueue stores a job and
+    returns at once, the worker threads started by start claim the oldest
+    queued job, run its handler and store the result. A job failing is
+    queued again until it has been tried max_attempts times, waiting
+    retry_delay seconds before the second attempt and twice as long before
+    each of the following ones.
+    """
+
+    def __init__(self, session, workers=2, poll_interval=1.0, max_attempts=3,
+                 retry_delay=30, stale_seconds=600, context=None,
+                 logger=None):
+        # session is a scoped session, each worker thread gets its own.
+        # Running jobs not updated for stale_seconds are claimed again, and
+        # context returns the context manager handlers run in (for example
+        # the Flask application context)
+        self.session = session
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.stale_seconds = stale_seconds
+        self.context = context
+        self.logger = logger or logging.getLogger(__name__)
+        self.handlers = {}
+        self.sensitive = set()
+        self.threads = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+
+    def register(self, kind, sensitive=False):
+        """Decorator registering the handler of a kind of job
+
+        The handler is called with the job arguments and a progress function
+        taking a number, what it returns is stored as the job result. The
+        arguments of sensitive jobs (access tokens) are erased once the job
+        is finished and their errors are only recorded by exception type, as
+        the messages can quote the arguments.
+        """
+        def decorator(handler):
+            self.handlers[kind] = handler
+            if sensitive:
+                self.sensitive.add(kind)
+            return handler
+        return decorator
+
+    def enqueue(self, kind, args=None, user_id=None):
+        """Store a new job and commit the session, return the job id"""
+        if kind not in self.handlers:
+            raise ValueError('Unknown job kind %s' % kind)
+        job = Job(kind=kind, args=json.dumps(args or {}), user_id=user_id)
+        self.session.add(job)
+        self.session.flush()
+        job_id = job.id
+        self.session.commit()
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def start(self):
+        """Start the worker threads of this process if not started yet"""
+        # Preforked servers call it in each process after the fork
+        with self._lock:
+            if self.threads or self.workers < 1:
+                return
+            self._stopping = False
+            # Workers are stopped before the interpreter tears down modules
+            atexit.register(self.stop, self.poll_interval)
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name='job-worker-%d' % number)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop the worker threads once their current job is finished"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.set()
+            for thread in self.threads:
+                thread.join(timeout)
+            self.threads = []
+
+    def work(self):
+        # Loop of every worker thread, waits for a job when none is queued
+        while not self._stopping:
+            try:
+                job = self.claim()
+            except Exception:
+                self.logger.exception('Could not claim a job')
+                self.session.remove()
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self.run(*job)
+
+    def claim(self):
+        """Mark the oldest waiting job as running
+
+        Return its (id, kind, args, attempts), or None if there is no job
+        or another worker claimed it first.
+        """
+        session = self.session
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.stale_seconds)
+        waiting = or_(
+            and_(Job.status == 'queued',
+                 or_(Job.not_before.is_(None), Job.not_before <= now)),
+            and_(Job.status == 'running', Job.updated < stale))
+        try:
+            job = session.query(Job.id, Job.kind, Job.args).filter(
+                waiting).order_by(Job.id).first()
+            if job is None:
+                return None
+            # Only one worker changes the status of a waiting job
+            claimed = session.query(Job).filter(
+                Job.id == job.id).filter(waiting).update({
+                    'status': 'running',
+                    'updated': now,
+                    'attempts': Job.attempts + 1,
+                }, synchronize_session=False)
+            attempts = session.query(Job.attempts).filter(
+                Job.id == job.id).scalar()
+            session.commit()
+        finally:
+            session.remove()
+        if not claimed:
+            return None
+        return job.id, job.kind, json.loads(job.args), attempts
+
+    def run(self, job_id, kind, args, attempts):
+        """Run the handler of a claimed job and store its outcome"""
+        def progress(value):
+            # Commits the session of the handler as well
+            self.update(job_id, progress=value)
+
+        try:
+            if attempts > self.max_attempts:
+                raise RuntimeError('Worker stopped during the last attempt')
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise ValueError('Unknown job kind %s' % kind)
+            if self.context is None:
+                result = handler(args, progress)
+            else:
+                with self.context():
+                    result = handler(args, progress)
+        except Exception as err:
+            self.session.rollback()
+            if kind in self.sensitive:
+                error = type(err).__name__
+                self.logger.error(
+                    'Job %d (%s) failed: %s', job_id, kind, error)
+            else:
+                error = str(err)
+                self.logger.exception('Job %d (%s) failed', job_id, kind)
+            if attempts < self.max_attempts:
+                delay = self.retry_delay * 2 ** (attempts - 1)
+                self.update(job_id, status='queued', error=error,
+                            not_before=datetime.datetime.utcnow() +
+                            datetime.timedelta(seconds=delay))
+            else:
+                self.finish(job_id, kind, status='failed', error=error)
+        else:
+            self.finish(job_id, kind, status='done',
+                        result=json.dumps(result), error=None)
+        finally:
+            self.session.remove()
+
+    def update(self, job_id, **values):
+        values['updated'] = datetime.datetime.utcnow()
+        self.session.query(Job).filter(Job.id == job_id).update(
+            values, synchronize_session=False)
+        self.session.commit()
+
+    def finish(self, job_id, kind, **values):
+        values['finished'] = datetime.datetime.utcnow()
+        if kind in self.sensitive:
+            values['args'] = '{}'
+        self.update(job_id, **values)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run or queue background jobs of the catalog')
+    parser.add_argument('action', choices=['work', 'enqueue'])
+    parser.add_argument('kind', nargs='?', help='kind of job to enqueue')
+    parser.add_argument('args', nargs='?', default='{}',
+                        help='JSON arguments of the job to enqueue')
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    # The handlers are registered by the application
+    import catalog
+    catalog.create_app({'JOB_WORKERS': args.workers})
+    queue = catalog.jobQueue
+    if args.action == 'enqueue':
+        if args.kind not in queue.handlers:
+            parser.error('kind must be one of %s' % ', '.join(
+                sorted(queue.handlers)))
+        queue.workers = 0
+        print('Job %d queued' % queue.enqueue(
+            args.kind, json.loads(args.args)))
+        return 0
+    queue.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        queue.stop()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
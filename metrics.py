@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+from flask import request
+from jinja2 import Template
+from sqlalchemy import event
+
+import threading
+import time
+
+# Upper bounds of the histogram buckets, in seconds for durations
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                    2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+
+
+class Histogram(object):
+    """Cumulative histogram of observations per route, Prometheus style"""
+
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, route, value):
+        series = self.series.get(route)
+        if series is None:
+            series = self.series[route] = [[0] * len(self.buckets), 0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def expose(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+        for route in sorted(self.series):
+            counts, total, count = self.series[route]
+            label = 'route="%s"' % route
+            for bound, value in zip(self.buckets, counts):
+                lines.append('%s_bucket{%s,le="%s"} %d'
+                             % (self.name, label, bound, value))
+            lines.append('%s_bucket{%s,le="+Inf"} %d'
+                         % (self.name, label, count))
+            lines.append('%s_sum{%s} %s' % (self.name, label, total))
+            lines.append('%s_count{%s} %d' % (self.name, label, count))
+        return lines
+
+
+class RequestMetrics(object):
+    """Per route timing of requests, SQL statements, template rendering and
+    calls to the login providers
+
+    Requests slower than slow_seconds are logged with the statements they
+    ran. caches maps a name to an object with a stats() method returning
+    hit and miss counters, they are exposed as well.
+    """
+
+    def __init__(self, app, slow_seconds=None, caches=None):
+        self.app = app
+        self.slow_seconds = slow_seconds
+        self.caches = caches or {}
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.duration = Histogram(
+            'catalog_request_duration_seconds',
+            'Wall time to serve a request', DURATION_BUCKETS)
+        self.statements = Histogram(
+            'catalog_request_sql_statements',
+            'SQL statements run by a request', COUNT_BUCKETS)
+        self.sql_duration = Histogram(
+            'catalog_request_sql_duration_seconds',
+            'Time spent in SQL statements by a request', DURATION_BUCKETS)
+        self.template_duration = Histogram(
+            'catalog_request_template_duration_seconds',
+            'Time spent rendering templates by a request', DURATION_BUCKETS)
+        self.provider_duration = Histogram(
+            'catalog_request_provider_duration_seconds',
+            'Time spent waiting for the login providers by a request',
+            DURATION_BUCKETS)
+        app.before_request(self.startRequest)
+        app.teardown_request(self.endRequest)
+        app.jinja_env.template_class = self.timedTemplateClass()
+
+    def timedTemplateClass(self):
+        metrics = self
+
+        class TimedTemplate(Template):
+            # Templates included by another one are timed with their parent
+            def render(self, *args, **kwargs):
+                state = metrics.current()
+                if state is None or state['rendering']:
+                    return Template.render(self, *args, **kwargs)
+                state['rendering'] = True
+                start = time.time()
+                try:
+                    return Template.render(self, *args, **kwargs)
+                finally:
+                    state['template_time'] += time.time() - start
+                    state['rendering'] = False
+        return TimedTemplate
+
+    def trackEngine(self, engine):
+        """Time the statements run through a database engine"""
+        event.listen(engine, 'before_cursor_execute', self.startStatement)
+        event.listen(engine, 'after_cursor_execute', self.endStatement)
+
+    def trackProviders(self, http):
+        """Time the requests sent through a requests session"""
+        http.hooks['response'].append(self.providerResponse)
+
+    def providerResponse(self, response, *args, **kwargs):
+        state = self.current()
+        if state is not None:
+            state['provider_time'] += response.elapsed.total_seconds()
+
+    def current(self):
+        return getattr(self.local, 'state', None)
+
+    def startRequest(self):
+        self.local.state = {
+            'start': time.time(),
+            'statements': 0,
+            'sql_time': 0.0,
+            'template_time': 0.0,
+            'provider_time': 0.0,
+            'rendering': False,
+            'slow_log': [] if self.slow_seconds is not None else None,
+        }
+
+    def startStatement(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        state = self.current()
+        if state is not None:
+            state['statement_start'] = time.time()
+
+    def endStatement(self, conn, cursor, statement, parameters, context,
+                     executemany):
+        state = self.current()
+        if state is None or 'statement_start' not in state:
+            return
+        elapsed = time.time() - state.pop('statement_start')
+        state['statements'] += 1
+        state['sql_time'] += elapsed
+        if state['slow_log'] is not None:
+            # Parameters are never kept, they hold tokens and emails
+            state['slow_log'].append((elapsed, statement))
+
+    def endRequest(self, exception=None):
+        state = self.current()
+        if state is None:
+            return
+        self.local.state = None
+        elapsed = time.time() - state['start']
+        route = request.endpoint or 'unknown'
+        with self.lock:
+            self.duration.observe(route, elapsed)
+            self.statements.observe(route, state['statements'])
+            self.sql_duration.observe(route, state['sql_time'])
+            self.template_duration.observe(route, state['template_time'])
+            self.provider_duration.observe(route, state['provider_time'])
+        if self.slow_seconds is not None and elapsed >= self.slow_seconds:
+            lines = ['Slow request %s %s (%s) %.3fs, %d statements %.3fs, '
+                     'templates %.3fs, providers %.3fs' % (
+                         request.method, request.path, route, elapsed,
+                         state['statements'], state['sql_time'],
+                         state['template_time'], state['provider_time'])]
+            for duration, statement in state['slow_log']:
+                lines.append('  %.3fs %s' % (
+                    duration, ' '.join(statement.split())))
+            self.app.logger.warning('\n'.join(lines))
+
+    def expose(self):
+        """Return all the metrics in Prometheus text format"""
+        lines = []
+        with self.lock:
+            for histogram in (self.duration, self.statements,
+                              self.sql_duration, self.template_duration,
+                              self.provider_duration):
+                lines.extend(histogram.expose())
+        for kind in ('hits', 'misses'):
+            name = 'catalog_cache_%s_total' % kind
+            lines.append('# HELP %s Cache %s' % (name, kind))
+            lines.append('# TYPE %s counter' % name)
+            for cache in sorted(self.caches):
+                lines.append('%s{cache="%s"} %d' % (
+                    name, cache, self.caches[cache].stats()[kind]))
+        return '\n'.join(lines) + '\n'
@@ -1,19 +1,39 @@
 #!/usr/bin/env python3
-from sqlalchemy import Column, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Integer, String, Index, DateTime, \
+    Text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, load_only, raiseload
+from sqlalchemy import create_engine, event, inspect, select, text
+from sqlalchemy.orm import sessionmaker, Session
+
+import datetime
+import json
+import os
+import sys
 
 Base = declarative_base()
 
 
+class SchemaError(Exception):
+    """Raised when the database can not be upgraded to the schema"""
+
+
 class User(Base):
     __tablename__ = 'user'
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250))
+    # Users are looked up by email at login and two concurrent first logins
+    # with the same email must not create two users
+    email = Column(String(250), index=True, unique=True)
     picture = Column(String(250))
+    # Number of catalog items owned by the user, kept up to date by every
+    # write of catalog items, see repairItemCounts
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    # Keys of serialize, selected as plain columns by the JSON views
+    serialize_fields = ('name', 'id', 'email', 'picture')
 
     @property
     def serialize(self):
@@ -30,9 +50,19 @@ class Category(Base):
     __tablename__ = 'category'
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(250), nullable=False)
+    name = Column(String(250), nullable=False, unique=True, index=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
+    # Sequence number of the last change to the category, see trackChanges
+    change_seq = Column(Integer, nullable=False, default=0,
+                        server_default='0', index=True)
+    change_kind = 'category'
+    # Number of catalog items in the category, kept up to date by every
+    # write of catalog items, see repairItemCounts
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+    # Keys of serialize, selected as plain columns by the JSON views
+    serialize_fields = ('name', 'id', 'user_id')
 
     @property
     def serialize(self):
@@ -46,6 +76,12 @@ class Category(Base):
 
 class CatalogItem(Base):
     __tablename__ = 'category_item'
+    # Items are looked up by title inside a category and titles can not be
+    # repeated in the same category
+    __table_args__ = (
+        Index('ix_category_item_category_id_title',
+              'category_id', 'title', unique=True),
+    )
 
     title = Column(String(80), nullable=False)
     id = Column(Integer, primary_key=True)
@@ -54,6 +90,26 @@ class CatalogItem(Base):
     category = relationship(Category)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
+    # Sequence number of the last change to the item, see trackChanges
+    change_seq = Column(Integer, nullable=False, default=0,
+                        server_default='0', index=True)
+    change_kind = 'item'
+    # Keys of serialize, selected as plain columns by the JSON views
+    serialize_fields = ('title', 'description', 'id', 'user_id',
+                        'category_id')
+    # Columns read by each kind of view, lists only render the title and
+    # link to the item, see loadProfile
+    load_profiles = {
+        'list': ('id', 'title'),
+        'detail': ('id', 'title', 'description', 'category_id', 'user_id'),
+    }
+
+    @classmethod
+    def loadProfile(cls, name):
+        """Return the query options that load only the profile columns"""
+        # The views using a profile never need the category or user
+        # relationships, accessing them raises instead of running a query
+        return (load_only(*cls.load_profiles[name]), raiseload('*'))
 
     @property
     def serialize(self):
@@ -67,6 +123,379 @@ class CatalogItem(Base):
         }
 
 
-engine = create_engine('sqlite:///catalog.db')
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_version'
+    # Single row incremented by every write, used to validate cached
+    # JSON responses without reading the catalog itself
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    modified = Column(DateTime, nullable=False,
+                      default=datetime.datetime.utcnow)
+    # Last change sequence number given to a category, item or tombstone
+    change_seq = Column(Integer, nullable=False, default=0,
+                        server_default='0')
+
+
+class Tombstone(Base):
+    __tablename__ = 'catalog_tombstone'
+    # A deleted category or catalog item, so clients following the change
+    # sequence learn about deletes
+
+    seq = Column(Integer, primary_key=True, autoincrement=False)
+    kind = Column(String(20), nullable=False)
+    record_id = Column(Integer, nullable=False)
+    deleted = Column(DateTime, nullable=False,
+                     default=datetime.datetime.utcnow)
+
+
+class Job(Base):
+    __tablename__ = 'job'
+    # Slow work (token revocation, category deletes, index rebuilds) run by
+    # the background workers of jobs.py instead of the request asking for it
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String(50), nullable=False)
+    # JSON encoded arguments of the job handler
+    args = Column(Text, nullable=False, default='{}')
+    # queued, running, done or failed
+    status = Column(String(20), nullable=False, default='queued', index=True)
+    progress = Column(Integer, nullable=False, default=0)
+    # JSON encoded value returned by the handler, or the last error
+    result = Column(Text)
+    error = Column(Text)
+    attempts = Column(Integer, nullable=False, default=0)
+    # User who asked for the job, the only one allowed to see it
+    user_id = Column(Integer, ForeignKey('user.id'))
+    created = Column(DateTime, nullable=False,
+                     default=datetime.datetime.utcnow)
+    # Set when the job is claimed and on every progress report, a running
+    # job not updated for a long time belongs to a dead worker
+    updated = Column(DateTime)
+    # A failed job is not tried again before this time
+    not_before = Column(DateTime)
+    finished = Column(DateTime)
+
+    @property
+    def serialize(self):
+        """Return object data in easily serializeable format"""
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': self.progress,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error,
+            'attempts': self.attempts,
+            'created': self.created.isoformat(),
+            'not_before': self.not_before and self.not_before.isoformat(),
+            'finished': self.finished and self.finished.isoformat(),
+        }
+
+
+def reserveChangeSeq(connection, count):
+    """Reserve count change sequence numbers, return the first one"""
+    # The catalog version row stays locked until the transaction ends, so
+    # changes are committed in the order of their sequence numbers
+    table = CatalogVersion.__table__
+    connection.execute(table.update().where(table.c.id == 1).values(
+        change_seq=table.c.change_seq + count))
+    last = connection.execute(
+        select([table.c.change_seq]).where(table.c.id == 1)).scalar()
+    return last - count + 1
+
+
+def addTombstones(session, kind, record_ids):
+    """Record the deletion of rows removed without the ORM (bulk deletes)"""
+    record_ids = list(record_ids)
+    if not record_ids:
+        return
+    seq = reserveChangeSeq(session.connection(), len(record_ids))
+    session.execute(Tombstone.__table__.insert(), [
+        {'seq': seq + i, 'kind': kind, 'record_id': record_id,
+         'deleted': datetime.datetime.utcnow()}
+        for i, record_id in enumerate(record_ids)])
+
+
+@event.listens_for(Session, 'before_flush')
+def trackChanges(session, flush_context, instances):
+    # Every category or item inserted or updated through the ORM gets the
+    # next change sequence number, deleted ones leave a tombstone
+    changed = [obj for obj in session.new
+               if isinstance(obj, (Category, CatalogItem))]
+    changed += [obj for obj in session.dirty
+                if isinstance(obj, (Category, CatalogItem)) and
+                session.is_modified(obj, include_collections=False)]
+    deleted = [obj for obj in session.deleted
+               if isinstance(obj, (Category, CatalogItem))]
+    if not changed and not deleted:
+        return
+    seq = reserveChangeSeq(session.connection(), len(changed) + len(deleted))
+    for obj in changed:
+        obj.change_seq = seq
+        seq += 1
+    for obj in deleted:
+        session.add(Tombstone(seq=seq, kind=obj.change_kind, record_id=obj.id))
+        seq += 1
+
+
+def sequenceNewRows(connection):
+    """Give change sequence numbers to rows inserted without the ORM"""
+    # Bulk inserts and columns added to an existing database leave
+    # change_seq at 0, the rows get distinct numbers after the last one
+    for table in (Category.__table__, CatalogItem.__table__):
+        last_id = connection.execute(
+            select([table.c.id]).where(table.c.change_seq == 0).order_by(
+                table.c.id.desc()).limit(1)).scalar()
+        if last_id is None:
+            continue
+        base = reserveChangeSeq(connection, last_id) - 1
+        connection.execute(table.update().where(
+            table.c.change_seq == 0).values(change_seq=table.c.id + base))
+
+
+def upgradeSchema(engine):
+    """Create any column or index missing from an existing database
+
+    Return the names (table.column) of the columns added. Raise SchemaError
+    when an index can not be built, the unique indexes are what keeps
+    duplicated names out so the database must not be used without them.
+    """
+    # create_all only adds columns and indexes when the table itself is
+    # created, so databases created before they were declared are upgraded
+    # here
+    inspector = inspect(engine)
+    added = []
+    failed = []
+    for table in Base.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (
+                table.name, column.name, column.type.compile(engine.dialect))
+            if column.server_default is not None:
+                ddl += " DEFAULT '%s'" % column.server_default.arg
+            if not column.nullable:
+                ddl += ' NOT NULL'
+            with engine.begin() as connection:
+                connection.execute(text(ddl))
+            added.append('%s.%s' % (table.name, column.name))
+        existing = dict((i['name'], bool(i['unique']))
+                        for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name in existing and (
+                    existing[index.name] or not index.unique):
+                continue
+            try:
+                if index.name in existing:
+                    replaceWithUniqueIndex(engine, index)
+                else:
+                    index.create(engine)
+            except IntegrityError as err:
+                failed.append('%s (%s)' % (index.name, err.orig))
+    if failed:
+        raise SchemaError(
+            'Indexes not created, remove duplicated rows first: %s'
+            % ', '.join(failed))
+    return added
+
+
+def replaceWithUniqueIndex(engine, index):
+    # An index declared unique after it was created is built again. The
+    # driver commits before every DDL statement, so the unique index is
+    # first tried under another name and the old one is kept when there are
+    # duplicated rows
+    quote = engine.dialect.identifier_preparer.quote
+    trial = quote(index.name + '_unique')
+    with engine.begin() as connection:
+        connection.execute(text('CREATE UNIQUE INDEX %s ON %s (%s)' % (
+            trial, quote(index.table.name),
+            ', '.join(quote(column.name) for column in index.columns))))
+        connection.execute(text('DROP INDEX %s' % trial))
+        index.drop(connection)
+        index.create(connection)
+
+
+def requireUniqueIndexes(engine):
+    """Raise SchemaError if a unique index of an existing table is missing
+
+    The write handlers rely on the unique indexes to reject duplicated
+    category names, item titles and user emails, they must not run without
+    them.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(i['name'] for i in inspector.get_indexes(table.name)
+                       if i['unique'])
+        missing.extend(index.name for index in table.indexes
+                       if index.unique and index.name not in existing)
+    if missing:
+        raise SchemaError('Unique indexes missing, run python models.py: %s'
+                          % ', '.join(missing))
+
+
+# Full text index over the title and description of catalog items. It is an
+# external content FTS5 table kept in sync by triggers, so every write path
+# (web handlers, batch API, bulk imports) updates it in the same transaction
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE category_item_fts USING fts5(
+        title, description, content='category_item', content_rowid='id')""",
+    """CREATE TRIGGER category_item_fts_insert AFTER INSERT ON category_item
+    BEGIN
+        INSERT INTO category_item_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER category_item_fts_delete AFTER DELETE ON category_item
+    BEGIN
+        INSERT INTO category_item_fts(category_item_fts, rowid, title,
+                                      description)
+        VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER category_item_fts_update AFTER UPDATE ON category_item
+    BEGIN
+        INSERT INTO category_item_fts(category_item_fts, rowid, title,
+                                      description)
+        VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO category_item_fts(rowid, title, description)
+        VALUES (new.id, new.title, new.description);
+    END""",
+]
+
+
+def createSearchIndex(engine):
+    """Create the full text index of catalog items if it does not exist"""
+    if engine.dialect.name != 'sqlite':
+        return
+    if 'category_item_fts' in inspect(engine).get_table_names():
+        return
+    with engine.begin() as connection:
+        for statement in SEARCH_INDEX_DDL:
+            connection.execute(text(statement))
+        # Index the items already in the database
+        connection.execute(text(
+            "INSERT INTO category_item_fts(category_item_fts) "
+            "VALUES ('rebuild')"))
+
+
+def rebuildSearchIndex(engine):
+    """Index every catalog item again in the full text index"""
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO category_item_fts(category_item_fts) "
+            "VALUES ('rebuild')"))
+
+
+def createCatalogVersion(engine):
+    """Insert the catalog version row if the database does not have it"""
+    session = sessionmaker(bind=engine)()
+    if not session.query(CatalogVersion).get(1):
+        session.add(CatalogVersion(id=1, version=0))
+        session.commit()
+    session.close()
+
+
+def repairItemCounts(engine):
+    """Recount the items of every category and user, return the number of
+    counters that were wrong"""
+    with engine.begin() as connection:
+        fixed = 0
+        for table, column in (('category', 'category_id'),
+                              ('user', 'user_id')):
+            count = ('(SELECT COUNT(*) FROM category_item '
+                     'WHERE category_item.%s = "%s".id)' % (column, table))
+            fixed += connection.execute(text(
+                'UPDATE "%s" SET item_count = %s WHERE item_count != %s'
+                % (table, count, count))).rowcount
+    return fixed
+
+
+def createSchema(engine):
+    """Create the tables, indexes and rows the application needs"""
+    Base.metadata.create_all(engine)
+    added = upgradeSchema(engine)
+    createSearchIndex(engine)
+    createCatalogVersion(engine)
+    # Counters added to an existing database start at zero
+    if 'category.item_count' in added or 'user.item_count' in added:
+        repairItemCounts(engine)
+    with engine.begin() as connection:
+        sequenceNewRows(connection)
+
+
+# PRAGMAs run on every new SQLite connection. 'tuned' uses WAL so readers
+# are not blocked while a write commits, syncs only at checkpoints, maps the
+# database file in memory and gives each connection a larger page cache.
+# 'default' restores the SQLite defaults, journal_mode is stored in the
+# database file so it has to be set back explicitly
+SQLITE_PROFILES = {
+    'tuned': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('busy_timeout', int(os.environ.get(
+            'CATALOG_SQLITE_BUSY_TIMEOUT', 5000))),
+        # Negative sizes are in KiB
+        ('cache_size', -int(os.environ.get(
+            'CATALOG_SQLITE_CACHE_KB', 32768))),
+        ('mmap_size', int(os.environ.get(
+            'CATALOG_SQLITE_MMAP_SIZE', 268435456))),
+        ('temp_store', 'MEMORY'),
+    ],
+    'default': [
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+        ('busy_timeout', 5000),
+        ('cache_size', -2000),
+        ('mmap_size', 0),
+        ('temp_store', 'DEFAULT'),
+    ],
+}
+
+
+def configureSqlite(engine, profile):
+    """Apply a SQLITE_PROFILES profile to every connection of the engine"""
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = SQLITE_PROFILES[profile]
+
+    def execute(dbapi_connection, names):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            if name in names:
+                cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    # journal_mode is stored in the database file and changing it needs the
+    # database for itself, so it is only set by the first connection
+    @event.listens_for(engine, 'first_connect')
+    def setJournalMode(dbapi_connection, connection_record):
+        execute(dbapi_connection, ['journal_mode'])
+
+    @event.listens_for(engine, 'connect')
+    def setPragmas(dbapi_connection, connection_record):
+        execute(dbapi_connection, [
+            name for name, value in pragmas if name != 'journal_mode'])
+
 
-Base.metadata.create_all(engine)
+if __name__ == '__main__':
+    # python models.py [DATABASE_URL] creates or upgrades the schema, the
+    # web application never does it on its own. With --repair-counts the
+    # item counters of categories and users are recounted as well
+    args = [arg for arg in sys.argv[1:] if arg != '--repair-counts']
+    url = args[0] if args else os.environ.get(
+        'CATALOG_DATABASE_URL', 'sqlite:///catalog.db')
+    engine = create_engine(url)
+    try:
+        createSchema(engine)
+    except SchemaError as err:
+        print(err)
+        sys.exit(1)
+    print("Schema of %s is up to date" % url)
+    if '--repair-counts' in sys.argv:
+        print("%d item counters repaired" % repairItemCounts(engine))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+from requests.adapters import HTTPAdapter
+
+import base64
+import json
+import os
+import requests
+import threading
+
+# Seconds to wait for a provider to answer and size of the keep-alive
+# connection pool shared by all the login handlers
+PROVIDER_TIMEOUT = float(os.environ.get('CATALOG_PROVIDER_TIMEOUT', 10))
+PROVIDER_POOL_SIZE = int(os.environ.get('CATALOG_PROVIDER_POOL_SIZE', 10))
+
+# Provider endpoints, they can be pointed to a local stub provider. The
+# google token endpoint defaults to the one in client_secrets.json
+GOOGLE_TOKEN_URL = os.environ.get('CATALOG_GOOGLE_TOKEN_URL')
+GOOGLE_API_URL = os.environ.get(
+    'CATALOG_GOOGLE_API_URL', 'https://www.googleapis.com')
+GOOGLE_ACCOUNTS_URL = os.environ.get(
+    'CATALOG_GOOGLE_ACCOUNTS_URL', 'https://accounts.google.com')
+FACEBOOK_GRAPH_URL = os.environ.get(
+    'CATALOG_FACEBOOK_GRAPH_URL', 'https://graph.facebook.com')
+
+
+class ProviderError(Exception):
+    """Raised when a provider rejects a request or can not be reached"""
+
+
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+def loadSecrets(filename):
+    """Return the 'web' section of a client secrets file, read only once"""
+    secrets = _secrets.get(filename)
+    if secrets is None:
+        with _secrets_lock:
+            secrets = _secrets.get(filename)
+            if secrets is None:
+                with open(filename, 'r') as f:
+                    secrets = json.load(f)['web']
+                _secrets[filename] = secrets
+    return secrets
+
+
+def _createSession():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=PROVIDER_POOL_SIZE, pool_maxsize=PROVIDER_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+# Shared by every request so TLS connections to the providers are reused
+http = _createSession()
+
+
+def providerRequest(method, url, **kwargs):
+    """Send a request to a provider through the shared connection pool"""
+    kwargs.setdefault('timeout', PROVIDER_TIMEOUT)
+    try:
+        return http.request(method, url, **kwargs)
+    except requests.RequestException as err:
+        # The requests message quotes the url with its tokens and secrets
+        raise ProviderError(
+            'Provider could not be reached (%s)' % type(err).__name__)
+
+
+def providerJSON(method, url, **kwargs):
+    """Send a request to a provider and return the decoded JSON answer"""
+    response = providerRequest(method, url, **kwargs)
+    try:
+        return response.json()
+    except ValueError:
+        raise ProviderError(
+            'Invalid answer from provider (status %d)' % response.status_code)
+
+
+def decodeIdToken(id_token):
+    """Return the claims of a JWT id token"""
+    # The token comes straight from the provider token endpoint over TLS and
+    # the access token is validated with tokeninfo, so like oauth2client the
+    # signature is not checked here
+    try:
+        payload = id_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(
+            payload.encode('ascii')).decode('utf-8'))
+    except (IndexError, ValueError, AttributeError):
+        raise ProviderError('Invalid id token')
+
+
+def exchangeGoogleCode(code, secrets):
+    """Upgrade a google authorization code into an access and id token"""
+    token_url = GOOGLE_TOKEN_URL or secrets.get(
+        'token_uri', 'https://oauth2.googleapis.com/token')
+    data = providerJSON('POST', token_url, data={
+        'grant_type': 'authorization_code',
+        'code': code,
+        'client_id': secrets['client_id'],
+        'client_secret': secrets['client_secret'],
+        'redirect_uri': 'postmessage',
+    })
+    if 'access_token' not in data or 'id_token' not in data:
+        raise ProviderError(data.get('error', 'Code exchange failed'))
+    return data['access_token'], decodeIdToken(data['id_token'])
+
+
+def googleTokenInfo(access_token):
+    """Return google's information about an access token"""
+    return providerJSON(
+        'GET', GOOGLE_API_URL + '/oauth2/v1/tokeninfo',
+        params={'access_token': access_token})
+
+
+def googleUserInfo(access_token):
+    """Return the google profile (name, picture, email) of the token user"""
+    return providerJSON(
+        'GET', GOOGLE_API_URL + '/oauth2/v1/userinfo',
+        params={'access_token': access_token, 'alt': 'json'})
+
+
+def googleRevoke(access_token):
+    """Revoke a google access token, return True if it was revoked"""
+    response = providerRequest(
+        'GET', GOOGLE_ACCOUNTS_URL + '/o/oauth2/revoke',
+        params={'token': access_token})
+    return response.status_code == 200
+
+
+def facebookExchangeToken(access_token, secrets):
+    """Exchange a short lived facebook token for a long lived one"""
+    data = providerJSON(
+        'GET', FACEBOOK_GRAPH_URL + '/oauth/access_token', params={
+            'grant_type': 'fb_exchange_token',
+            'client_id': secrets['app_id'],
+            'client_secret': secrets['app_secret'],
+            'fb_exchange_token': access_token,
+        })
+    if 'access_token' not in data:
+        raise ProviderError(data.get('error', 'Token exchange failed'))
+    return data['access_token']
+
+
+def facebookUserInfo(access_token):
+    """Return the facebook profile (name, id, email) of the token user"""
+    return providerJSON(
+        'GET', FACEBOOK_GRAPH_URL + '/v2.8/me',
+        params={'access_token': access_token, 'fields': 'name,id,email'})
+
+
+def facebookPicture(access_token):
+    """Return the url of the facebook picture of the token user"""
+    data = providerJSON(
+        'GET', FACEBOOK_GRAPH_URL + '/v2.8/me/picture', params={
+            'access_token': access_token,
+            'redirect': 0,
+            'height': 200,
+            'width': 200,
+        })
+    return data['data']['url']
+
+
+def facebookRevoke(facebook_id, access_token):
+    """Revoke the permissions granted by a facebook user to the app"""
+    response = providerRequest(
+        'DELETE', FACEBOOK_GRAPH_URL + '/%s/permissions' % facebook_id,
+        params={'access_token': access_token})
+    return response.status_code == 200
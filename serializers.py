@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+from json.encoder import encode_basestring_ascii
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Media types of the compact binary format, only offered when the msgpack
+# package is installed
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def encodeValue(value):
+    # Same output as the json module for the column types of the catalog
+    if value is None:
+        return 'null'
+    if isinstance(value, string_types):
+        return encode_basestring_ascii(value)
+    return json.dumps(value)
+
+
+class RowSerializer(object):
+    """Serialize plain column tuples like the serialize property of a model
+
+    fields are the keys of the serialize dictionary, rows are tuples with
+    one value per field in the same order. The JSON of a row is built from
+    a template with the keys already sorted, which gives the same bytes as
+    jsonify without building a dictionary or an ORM object per row.
+    """
+
+    def __init__(self, fields):
+        self.fields = tuple(fields)
+        self.order = sorted(range(len(fields)), key=lambda i: fields[i])
+        self.template = '{%s}' % ','.join(
+            '%s:%%s' % encode_basestring_ascii(fields[i])
+            for i in self.order)
+
+    def columns(self, model):
+        """Return the model columns to query, in field order"""
+        return [getattr(model, field) for field in self.fields]
+
+    def toDict(self, row):
+        return dict(zip(self.fields, row))
+
+    def toJSON(self, row):
+        return self.template % tuple([encodeValue(row[i]) for i in self.order])
+
+    def one(self, row):
+        """Mark a row to be serialized as an object inside a payload"""
+        return Serialized(self, row, False)
+
+    def many(self, rows):
+        """Mark rows to be serialized as a list of objects inside a payload"""
+        return Serialized(self, rows, True)
+
+
+class Serialized(object):
+    # Rows waiting to be encoded by encodeJSON or converted by toPlain
+
+    def __init__(self, serializer, rows, many):
+        self.serializer = serializer
+        self.rows = rows
+        self.many = many
+
+    def toJSON(self):
+        if self.many:
+            return '[%s]' % ','.join(
+                [self.serializer.toJSON(row) for row in self.rows])
+        return self.serializer.toJSON(self.rows)
+
+    def toPlain(self):
+        if self.many:
+            return [self.serializer.toDict(row) for row in self.rows]
+        return self.serializer.toDict(self.rows)
+
+
+def toPlain(payload):
+    """Return the payload with serialized rows turned into dictionaries"""
+    return dict(
+        (key, value.toPlain() if isinstance(value, Serialized) else value)
+        for key, value in payload.items())
+
+
+def encodeJSON(payload):
+    """Encode a payload dictionary as jsonify does with its defaults"""
+    # Compact separators, sorted keys, ASCII only and a trailing newline
+    parts = []
+    for key in sorted(payload):
+        value = payload[key]
+        if isinstance(value, Serialized):
+            text = value.toJSON()
+        else:
+            text = json.dumps(value, sort_keys=True, separators=(',', ':'))
+        parts.append('%s:%s' % (encode_basestring_ascii(key), text))
+    return '{%s}\n' % ','.join(parts)
+
+
+def encodeMsgpack(payload):
+    """Encode a payload dictionary as MessagePack"""
+    return msgpack.packb(toPlain(payload), use_bin_type=True)
@@ -0,0 +1,77 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog  # noqa: E402
+from models import Base, User, createSchema  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def app():
+    # One application per test run on a temporary SQLite database, the
+    # engine is created once per process
+    directory = tempfile.mkdtemp()
+    catalog.create_app({
+        'DATABASE_URL': 'sqlite:///%s' % os.path.join(directory, 'catalog.db'),
+        'SECRET_KEY': 'test',
+        'TESTING': True,
+        'JOB_WORKERS': 0,
+    })
+    createSchema(catalog.getEngine())
+    yield catalog.app
+    catalog.getEngine().dispose()
+    shutil.rmtree(directory)
+
+
+@pytest.fixture(autouse=True)
+def database(app):
+    # Every test starts with an empty catalog and empty caches
+    yield
+    catalog.session.remove()
+    engine = catalog.getEngine()
+    with engine.begin() as connection:
+        for table in reversed(Base.metadata.sorted_tables):
+            connection.execute(table.delete())
+    createSchema(engine)
+    catalog.pageCache.clear()
+    catalog.tokenCache.clear()
+    catalog.categoryDirectory.refresh()
+    catalog.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def addUser(name='user'):
+    """Insert a user and return its id"""
+    user = User(name=name, email='%s@example.com' % name, picture='')
+    catalog.session.add(user)
+    catalog.session.commit()
+    user_id = user.id
+    catalog.session.remove()
+    return user_id
+
+
+def login(client, user_id):
+    """Log the test client in as the given user"""
+    with client.session_transaction() as login_session:
+        login_session['username'] = 'user %d' % user_id
+        login_session['user_id'] = user_id
+        login_session['email'] = 'user%d@example.com' % user_id
+        login_session['picture'] = ''
+
+
+def runJobs():
+    """Run the queued jobs, the tests have no job workers"""
+    while True:
+        job = catalog.jobQueue.claim()
+        if job is None:
+            return
+        catalog.jobQueue.run(*job)
@@ -0,0 +1,135 @@
+"""Local stand-in for the google and facebook endpoints used at login"""
+import base64
+import json
+import socket
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+CLIENT_ID = 'stub-client-id'
+GOOGLE_ID = 'google-user-1'
+FACEBOOK_ID = 'facebook-user-1'
+
+
+def idToken(claims):
+    payload = base64.urlsafe_b64encode(
+        json.dumps(claims).encode('utf-8')).decode('ascii').rstrip('=')
+    return 'header.%s.signature' % payload
+
+
+def closedUrl():
+    """Return the url of a local port nothing listens on"""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d' % port
+
+
+class StubProvider(ThreadingMixIn, HTTPServer):
+    """Answers like the providers and records every call and connection"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.url = 'http://127.0.0.1:%d' % self.server_port
+        self.calls = []
+        self.connections = 0
+        self.used_codes = set()
+        self.revoke_status = 200
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def paths(self):
+        return [path for method, path in self.calls]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open between requests, one handler
+    # serves every request of a connection
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def route(self, method):
+        url = urlparse(self.path)
+        params = dict((key, values[0])
+                      for key, values in parse_qs(url.query).items())
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length).decode('utf-8')
+            params.update((key, values[0])
+                          for key, values in parse_qs(body).items())
+        self.server.calls.append((method, url.path))
+        return url.path, params
+
+    def do_POST(self):
+        path, params = self.route('POST')
+        if path == '/token':
+            # Authorization codes can only be exchanged once
+            code = params.get('code')
+            if code in self.server.used_codes or code == 'bad':
+                return self.answer(400, {'error': 'invalid_grant'})
+            self.server.used_codes.add(code)
+            return self.answer(200, {
+                'access_token': 'google-token-%s' % code,
+                'id_token': idToken({'sub': GOOGLE_ID}),
+            })
+        self.answer(404, {'error': 'not found'})
+
+    def do_GET(self):
+        path, params = self.route('GET')
+        if path == '/oauth2/v1/tokeninfo':
+            return self.answer(200, {
+                'user_id': GOOGLE_ID, 'issued_to': CLIENT_ID})
+        if path == '/oauth2/v1/userinfo':
+            return self.answer(200, {
+                'name': 'Google User', 'picture': 'https://example.com/g',
+                'email': 'google@example.com'})
+        if path == '/o/oauth2/revoke':
+            return self.answer(self.server.revoke_status, {})
+        if path == '/oauth/access_token':
+            return self.answer(200, {'access_token': 'facebook-long-token'})
+        if path == '/v2.8/me':
+            return self.answer(200, {
+                'name': 'Facebook User', 'id': FACEBOOK_ID,
+                'email': 'facebook@example.com'})
+        if path == '/v2.8/me/picture':
+            return self.answer(200, {
+                'data': {'url': 'https://example.com/f'}})
+        self.answer(404, {'error': 'not found'})
+
+    def do_DELETE(self):
+        path, params = self.route('DELETE')
+        if path == '/%s/permissions' % FACEBOOK_ID:
+            return self.answer(self.server.revoke_status, {'success': True})
+        self.answer(404, {'error': 'not found'})
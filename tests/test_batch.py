@@ -0,0 +1,70 @@
+import json
+
+import catalog
+from conftest import addUser, login
+from models import Category, CatalogItem
+
+
+def addCategory(user_id, name='Soccer'):
+    category = Category(name=name, user_id=user_id)
+    catalog.session.add(category)
+    catalog.session.commit()
+    category_id = category.id
+    catalog.session.remove()
+    catalog.categoryDirectory.refresh()
+    catalog.session.remove()
+    return category_id
+
+
+def batch(client, operations):
+    response = client.post(
+        '/catalog/item/batch/JSON',
+        data=json.dumps({'operations': operations}),
+        content_type='application/json')
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))['results']
+
+
+def test_malformed_fields_get_an_error_per_operation(client):
+    user_id = addUser()
+    category_id = addCategory(user_id)
+    login(client, user_id)
+    results = batch(client, [
+        {'op': 'delete', 'id': [1]},
+        {'op': 'create', 'title': ['x'], 'category_id': category_id},
+        {'op': 'create', 'title': 'Ball', 'category_id': str(category_id)},
+        {'op': 'update', 'id': True, 'title': 'Net'},
+        {'op': 'create', 'title': 'Net', 'description': {'a': 1},
+         'category_id': category_id},
+        {'op': 'create', 'title': 'Ball', 'category': [category_id]},
+        {'op': 'create', 'title': 'Ball', 'category_id': category_id},
+    ])
+    assert [result.get('error') for result in results] == [
+        'id must be an integer',
+        'title must be a string',
+        'category_id must be an integer',
+        'id must be an integer',
+        'description must be a string',
+        'category must be a string',
+        None,
+    ]
+    assert results[-1]['status'] == 'created'
+    assert catalog.session.query(CatalogItem).count() == 1
+
+
+def test_operations_that_are_not_objects_are_rejected(client):
+    user_id = addUser()
+    login(client, user_id)
+    results = batch(client, [1, 'delete', None])
+    assert [result['error'] for result in results] == [
+        'op must be create, update or delete'] * 3
+
+
+def test_bodies_that_are_not_objects_are_rejected(client):
+    login(client, addUser())
+    for body in ('[1, 2]', '"operations"', '3', 'null', 'not json'):
+        response = client.post('/catalog/item/batch/JSON', data=body,
+                               content_type='application/json')
+        assert response.status_code == 400
+        assert 'operations must be a list' in json.loads(
+            response.get_data(as_text=True))
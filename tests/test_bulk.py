@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+import bulk
+
+CATEGORIES = u'name,user_id\ncafé,1\nSoccer,1\n'
+ITEMS = (u'title,description,category,user_id\n'
+         u'Crème,Très bon,café,1\n'
+         u'Ball,Round,Soccer,1\n')
+
+
+@pytest.fixture
+def database(tmpdir):
+    return 'sqlite:///%s' % tmpdir.join('bulk.db')
+
+
+def writeFile(tmpdir, name, text):
+    path = str(tmpdir.join(name))
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def readFile(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def run(database, *args):
+    assert bulk.main(list(args) + ['--database', database]) == 0
+
+
+def test_csv_round_trip_keeps_non_ascii_text(database, tmpdir):
+    run(database, 'import', 'categories',
+        writeFile(tmpdir, 'categories.csv', CATEGORIES))
+    run(database, 'import', 'items', writeFile(tmpdir, 'items.csv', ITEMS))
+    exported = str(tmpdir.join('export.csv'))
+    run(database, 'export', 'items', exported)
+    lines = readFile(exported).splitlines()
+    assert len(lines) == 3
+    assert u'Crème,Très bon,café' in lines[1]
+    run(database, 'export', 'categories', exported)
+    assert u'café' in readFile(exported)
+
+
+def test_ndjson_import_keeps_non_ascii_text(database, tmpdir):
+    records = [{'name': u'café', 'user_id': 1}]
+    path = writeFile(tmpdir, 'categories.ndjson', u'\n'.join(
+        json.dumps(record) for record in records) + u'\n')
+    run(database, 'import', 'categories', path)
+    exported = str(tmpdir.join('export.ndjson'))
+    run(database, 'export', 'categories', exported)
+    assert json.loads(readFile(exported))['name'] == u'café'
+
+
+def test_imported_files_are_closed(database, tmpdir, monkeypatch):
+    opened = []
+    original = open
+
+    def tracking(*args, **kwargs):
+        f = original(*args, **kwargs)
+        opened.append(f)
+        return f
+
+    monkeypatch.setattr(bulk, 'open', tracking, raising=False)
+    run(database, 'import', 'categories',
+        writeFile(tmpdir, 'categories.csv', CATEGORIES))
+    run(database, 'export', 'categories', str(tmpdir.join('export.csv')))
+    assert len(opened) == 2
+    assert all(f.closed for f in opened)
@@ -0,0 +1,94 @@
+import datetime
+import json
+
+from sqlalchemy import create_engine, text
+
+import catalog
+from conftest import addUser, login
+from models import CatalogItem
+
+
+def writeFromOtherProcess(statement, **params):
+    # A second engine stands for another worker process: it writes and bumps
+    # the catalog version without touching this process's directory
+    engine = create_engine(catalog.app.config['DATABASE_URL'])
+    with engine.begin() as connection:
+        connection.execute(text(statement), **params)
+        connection.execute(text(
+            'UPDATE catalog_version SET version = version + 1, '
+            'modified = :modified WHERE id = 1'),
+            modified=datetime.datetime.utcnow())
+    engine.dispose()
+
+
+def addOtherCategory(user_id):
+    writeFromOtherProcess(
+        "INSERT INTO category (name, user_id, item_count, change_seq) "
+        "VALUES ('Other', :user_id, 0, 0)", user_id=user_id)
+
+
+def test_json_sees_categories_written_by_other_processes(client):
+    user_id = addUser()
+    # Load the directory and get the validator of the current version
+    first = client.get('/catalog/Other/JSON')
+    assert json.loads(first.get_data(as_text=True)) == {'category': []}
+    addOtherCategory(user_id)
+    response = client.get('/catalog/Other/JSON', headers={
+        'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != first.headers['ETag']
+    assert json.loads(response.get_data(as_text=True))['category'][
+        'name'] == 'Other'
+    again = client.get('/catalog/Other/JSON', headers={
+        'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304
+
+
+def test_directory_reloads_when_the_version_changes(client):
+    user_id = addUser()
+    login(client, user_id)
+    client.get('/')
+    addOtherCategory(user_id)
+    response = client.post('/catalog/item/new', data={
+        'title': 'Ball', 'description': '', 'category': 'Other'})
+    assert response.status_code == 302
+    item = catalog.session.query(CatalogItem).filter_by(title='Ball').one()
+    assert item.category_id == catalog.categoryDirectory.byName('Other').id
+
+
+def test_batch_accepts_categories_written_by_other_processes(client):
+    user_id = addUser()
+    login(client, user_id)
+    client.get('/')
+    addOtherCategory(user_id)
+    response = client.post('/catalog/item/batch/JSON', data=json.dumps({
+        'operations': [{'op': 'create', 'title': 'Net',
+                        'category': 'Other'}]}),
+        content_type='application/json')
+    results = json.loads(response.get_data(as_text=True))['results']
+    assert results[0]['status'] == 'created'
+
+
+def test_pages_see_items_written_by_other_processes(client):
+    user_id = addUser()
+    addOtherCategory(user_id)
+    assert b'Kite' not in client.get('/').data
+    assert b'Kite' not in client.get('/catalog/Other').data
+    writeFromOtherProcess(
+        "INSERT INTO category_item (title, description, category_id, "
+        "user_id, change_seq) SELECT 'Kite', '', id, :user_id, 0 "
+        "FROM category WHERE name = 'Other'", user_id=user_id)
+    assert b'Kite' in client.get('/').data
+    assert b'Kite' in client.get('/catalog/Other').data
+
+
+def test_cached_pages_skip_the_directory(client, monkeypatch):
+    addOtherCategory(addUser())
+    pages = [client.get('/').data, client.get('/catalog/Other').data]
+
+    def unused():
+        raise AssertionError('the directory was read')
+
+    monkeypatch.setattr(catalog.categoryDirectory, 'all', unused)
+    monkeypatch.setattr(catalog.categoryDirectory, 'byName', unused)
+    assert [client.get('/').data, client.get('/catalog/Other').data] == pages
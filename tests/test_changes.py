@@ -0,0 +1,85 @@
+import json
+
+import catalog
+from conftest import addUser, login, runJobs
+from models import Category, CatalogItem
+
+PAGE_SIZE = 2
+
+
+def post(client, url, data):
+    response = client.post(url, data=json.dumps(data),
+                           content_type='application/json')
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def changes(client, since, limit):
+    response = client.get('/catalog/changes/JSON?since=%d&limit=%d'
+                          % (since, limit))
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def entries(page):
+    # (seq, kind, id) of every change of a page, in seq order
+    rows = ([(row['change_seq'], 'category', row['id'])
+             for row in page['categories']] +
+            [(row['change_seq'], 'item', row['id'])
+             for row in page['items']] +
+            [(row['seq'], 'deleted ' + row['kind'], row['id'])
+             for row in page['deleted']])
+    return sorted(rows)
+
+
+def test_pages_return_every_change_once_in_order(client, monkeypatch):
+    # Category deletes run in chunks of two items
+    monkeypatch.setattr(catalog, 'DELETE_CHUNK_SIZE', 2)
+    monkeypatch.setattr(catalog, 'DELETE_CHUNK_PAUSE', 0)
+    login(client, addUser())
+    for name in ('Soccer', 'Hockey', 'Chess'):
+        assert client.post('/catalog/new', data={'name': name}).status_code \
+            == 302
+    created = post(client, '/catalog/item/batch/JSON', {'operations': [
+        {'op': 'create', 'title': 'Item %d' % number,
+         'category': 'Chess' if number > 4 else 'Soccer'}
+        for number in range(8)]})['results']
+    ids = [result['id'] for result in created]
+    post(client, '/catalog/item/batch/JSON', {'operations': [
+        {'op': 'update', 'id': ids[1], 'category': 'Hockey'},
+        {'op': 'delete', 'id': ids[2]}]})
+    chess_id = catalog.session.query(Category.id).filter_by(
+        name='Chess').scalar()
+    catalog.session.remove()
+    assert client.post('/catalog/Chess/delete').status_code == 302
+    runJobs()
+
+    pages = []
+    since, more = 0, True
+    while more:
+        page = changes(client, since, PAGE_SIZE)
+        rows = entries(page)
+        assert 0 < len(rows) <= PAGE_SIZE
+        assert rows[0][0] > since
+        assert page['next'] == rows[-1][0]
+        pages.extend(rows)
+        since, more = page['next'], page['more']
+    assert changes(client, since, PAGE_SIZE)['items'] == []
+
+    # Every change once, in seq order, and the same as a single page
+    seqs = [seq for seq, kind, record_id in pages]
+    assert seqs == sorted(set(seqs))
+    assert pages == entries(changes(client, 0, catalog.MAX_PAGE_SIZE))
+    records = [(kind, record_id) for seq, kind, record_id in pages]
+    assert len(records) == len(set(records))
+    session = catalog.session
+    assert sorted(records) == sorted(
+        [('category', row.id) for row in session.query(Category.id)] +
+        [('item', row.id) for row in session.query(CatalogItem.id)] +
+        [('deleted item', item_id) for item_id in [ids[2]] + ids[5:]] +
+        [('deleted category', chess_id)])
+    # The moved item is listed with its new category
+    moved = changes(client, 0, catalog.MAX_PAGE_SIZE)['items']
+    hockey = session.query(Category).filter_by(name='Hockey').one()
+    assert [item['category_id'] for item in moved
+            if item['id'] == ids[1]] == [hockey.id]
@@ -0,0 +1,104 @@
+import json
+import threading
+
+import catalog
+from conftest import addUser, login
+from models import Category, CatalogItem
+
+THREADS = 16
+REQUESTS_PER_THREAD = 20
+
+ENDPOINTS = [
+    '/catalog/JSON',
+    '/catalog/item/JSON',
+    '/catalog/1/item/JSON',
+    '/catalog/Category 1/item/JSON',
+    '/catalog/1/item/1/JSON',
+    '/catalog/user/JSON',
+    '/catalog/user/1/JSON',
+    '/catalog/stats/JSON',
+]
+
+
+def addCatalog():
+    user_id = addUser()
+    session = catalog.session
+    for number in range(3):
+        category = Category(name='Category %d' % number, user_id=user_id)
+        session.add(category)
+        session.flush()
+        for item in range(20):
+            session.add(CatalogItem(
+                title='Item %d' % item, description='', user_id=user_id,
+                category_id=category.id))
+    session.commit()
+    session.remove()
+    catalog.categoryDirectory.refresh()
+    catalog.session.remove()
+    return user_id
+
+
+def runThreads(target, count):
+    errors = []
+
+    def run(number):
+        try:
+            target(number)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(number,))
+               for number in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def test_json_endpoints_from_many_threads(app):
+    user_id = addCatalog()
+    failures = []
+
+    def reader(number):
+        client = app.test_client()
+        for request in range(REQUESTS_PER_THREAD):
+            url = ENDPOINTS[(number + request) % len(ENDPOINTS)]
+            response = client.get(url)
+            if response.status_code != 200:
+                failures.append((url, response.status_code))
+                continue
+            json.loads(response.get_data(as_text=True))
+
+    def writer(number):
+        client = app.test_client()
+        login(client, user_id)
+        for request in range(REQUESTS_PER_THREAD):
+            response = client.post('/catalog/item/batch/JSON', data=json.dumps(
+                {'operations': [{'op': 'create', 'category_id': 1,
+                                 'title': 'New %d %d' % (number, request)}]}),
+                content_type='application/json')
+            if response.status_code != 200:
+                failures.append(('batch', response.status_code))
+
+    errors = runThreads(
+        lambda number: (writer if number == 0 else reader)(number), THREADS)
+    assert errors == []
+    assert failures == []
+    # Every request gave its connection back to the pool
+    assert catalog.getEngine().pool.checkedout() == 0
+    items = catalog.session.query(CatalogItem).filter_by(
+        category_id=1).count()
+    assert items == 20 + REQUESTS_PER_THREAD
+
+
+def test_sessions_are_not_shared_between_threads(app):
+    addCatalog()
+    sessions = []
+
+    def worker(number):
+        with app.test_request_context('/'):
+            sessions.append(catalog.session())
+
+    assert runThreads(worker, 8) == []
+    assert len(set(id(session) for session in sessions)) == 8
@@ -0,0 +1,21 @@
+import pytest
+
+import catalog
+
+
+def test_engine_settings_can_not_change_once_the_engine_exists(app):
+    catalog.getEngine()
+    with pytest.raises(RuntimeError) as error:
+        catalog.create_app({'POOL_SIZE': 1, 'DATABASE_URL': 'sqlite://'})
+    assert 'DATABASE_URL, POOL_SIZE' in str(error.value)
+    assert app.config['DATABASE_URL'] != 'sqlite://'
+    assert app.config['POOL_SIZE'] != 1
+
+
+def test_other_settings_can_still_be_changed(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'SLOW_REQUEST_SECONDS', None)
+    url = app.config['DATABASE_URL']
+    assert catalog.create_app({
+        'DATABASE_URL': url, 'SLOW_REQUEST_SECONDS': 2.5}) is app
+    assert catalog.requestMetrics.slow_seconds == 2.5
+    catalog.create_app({'SLOW_REQUEST_SECONDS': None})
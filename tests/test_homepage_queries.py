@@ -0,0 +1,68 @@
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+import catalog
+from conftest import addUser
+from models import Category, CatalogItem
+
+
+@contextmanager
+def countStatements():
+    # Number of SQL statements run inside the block
+    engine = catalog.getEngine()
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+
+def addCatalog(categories, items_per_category, prefix='Category'):
+    user_id = addUser(prefix)
+    session = catalog.session
+    for number in range(categories):
+        category = Category(name='%s %d' % (prefix, number), user_id=user_id)
+        session.add(category)
+        session.flush()
+        for item in range(items_per_category):
+            session.add(CatalogItem(
+                title='Item %d' % item, description='', user_id=user_id,
+                category_id=category.id))
+    session.commit()
+    session.remove()
+    catalog.categoryDirectory.refresh()
+    catalog.session.remove()
+
+
+def renderHomepage(client):
+    # The rendered page is cached, only a render runs the queries
+    catalog.pageCache.clear()
+    with countStatements() as statements:
+        response = client.get('/')
+    assert response.status_code == 200
+    return response, statements
+
+
+def test_homepage_statements_do_not_grow_with_items(client):
+    addCatalog(2, 1, 'Small')
+    small, small_statements = renderHomepage(client)
+    addCatalog(10, 5)
+    large, large_statements = renderHomepage(client)
+    assert len(large_statements) == len(small_statements)
+    # The latest items and their category names come from one query
+    assert len(large_statements) <= 3
+    assert b'Category 9' in large.data
+
+
+def test_homepage_lists_latest_items_with_their_category(client):
+    addCatalog(3, 4)
+    response, statements = renderHomepage(client)
+    page = response.get_data(as_text=True)
+    assert page.count('Item 3') >= 3
+    assert 'Category 2' in page
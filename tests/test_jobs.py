@@ -0,0 +1,120 @@
+import datetime
+import json
+
+import pytest
+
+import catalog
+import providers
+from conftest import addUser, login, runJobs
+from models import Category, CatalogItem, Job
+from stubprovider import closedUrl
+
+TOKEN = 'ya29.SECRET_TOKEN'
+
+
+@pytest.fixture
+def unreachableGoogle(monkeypatch):
+    # Every revocation fails to connect
+    monkeypatch.setattr(providers, 'GOOGLE_ACCOUNTS_URL', closedUrl())
+
+
+def logoutFromGoogle(client, user_id):
+    login(client, user_id)
+    with client.session_transaction() as login_session:
+        login_session['provider'] = 'google'
+        login_session['access_token'] = TOKEN
+        login_session['gplus_id'] = 'google-user-1'
+    client.get('/disconnect')
+    job = catalog.session.query(Job).filter_by(kind='revoke_google').one()
+    job_id = job.id
+    catalog.session.remove()
+    return job_id
+
+
+def jobStatus(client, job_id):
+    response = client.get('/catalog/job/%d/JSON' % job_id)
+    assert response.status_code == 200
+    return response.get_data(as_text=True)
+
+
+def test_failed_revocation_does_not_expose_the_token(
+        app, client, unreachableGoogle):
+    user_id = addUser()
+    job_id = logoutFromGoogle(client, user_id)
+    runJobs()
+    anonymous = jobStatus(app.test_client(), job_id)
+    assert json.loads(anonymous) == {'job': []}
+    # The browser that logged out still has the user id in its session
+    assert json.loads(jobStatus(client, job_id)) == {'job': []}
+    owner = app.test_client()
+    login(owner, user_id)
+    status = jobStatus(owner, job_id)
+    assert TOKEN not in status
+    job = json.loads(status)['job']
+    assert job['status'] == 'queued'
+    assert job['error'] == 'ProviderError'
+
+
+def test_failed_jobs_are_retried_after_a_delay(client, unreachableGoogle):
+    user_id = addUser()
+    job_id = logoutFromGoogle(client, user_id)
+    runJobs()
+    # The next attempt waits for the backoff delay
+    assert catalog.jobQueue.claim() is None
+    delays = []
+    for attempt in range(catalog.jobQueue.max_attempts - 1):
+        job = catalog.session.query(Job).get(job_id)
+        delays.append(job.not_before - job.updated)
+        job.not_before = datetime.datetime.utcnow()
+        catalog.session.commit()
+        catalog.session.remove()
+        runJobs()
+    assert delays[1] > delays[0] > datetime.timedelta(0)
+    job = catalog.session.query(Job).get(job_id)
+    assert job.status == 'failed'
+    assert job.attempts == catalog.jobQueue.max_attempts
+    assert job.args == '{}'
+
+
+def test_jobs_without_owner_are_not_shown(client):
+    login(client, addUser())
+    job_id = catalog.jobQueue.enqueue('repair_item_counts')
+    assert json.loads(jobStatus(client, job_id)) == {'job': []}
+    runJobs()
+    assert json.loads(jobStatus(client, job_id)) == {'job': []}
+
+
+def test_category_delete_runs_as_a_job(app, client):
+    user_id = addUser()
+    category = Category(name='Soccer', user_id=user_id)
+    catalog.session.add(category)
+    catalog.session.flush()
+    catalog.session.add_all([
+        CatalogItem(title='Item %d' % number, category_id=category.id,
+                    user_id=user_id) for number in range(5)])
+    catalog.session.commit()
+    catalog.session.remove()
+    login(client, user_id)
+    client.post('/catalog/Soccer/delete')
+    job = catalog.session.query(Job).filter_by(kind='delete_category').one()
+    job_id = job.id
+    catalog.session.remove()
+    assert json.loads(jobStatus(client, job_id))['job']['status'] == 'queued'
+    runJobs()
+    job = json.loads(jobStatus(client, job_id))['job']
+    assert job['status'] == 'done'
+    assert job['result'] == {'deleted': 5}
+    assert catalog.session.query(Category).count() == 0
+    other = app.test_client()
+    login(other, addUser('other'))
+    assert json.loads(jobStatus(other, job_id)) == {'job': []}
+
+
+def test_slow_request_log_does_not_expose_the_token(
+        client, monkeypatch, caplog):
+    # Every request is slow, its statements are logged
+    monkeypatch.setattr(catalog.requestMetrics, 'slow_seconds', 0)
+    logoutFromGoogle(client, addUser())
+    assert 'INSERT INTO job' in caplog.text
+    assert TOKEN not in caplog.text
+    assert 'user@example.com' not in caplog.text
@@ -0,0 +1,27 @@
+import json
+
+import catalog
+from conftest import addUser
+from models import Category
+
+
+def categories(client, query):
+    response = client.get('/catalog/JSON?' + query)
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+def test_only_all_1_returns_every_row(client):
+    user_id = addUser()
+    catalog.session.add_all([Category(name='Category %d' % number,
+                                      user_id=user_id)
+                             for number in range(5)])
+    catalog.session.commit()
+    catalog.session.remove()
+    page = categories(client, 'all=1&limit=2')
+    assert len(page['categories']) == 5
+    assert page['next'] is None
+    for query in ('all=0&limit=2', 'all=false&limit=2', 'all=&limit=2'):
+        page = categories(client, query)
+        assert len(page['categories']) == 2
+        assert page['next'] == page['categories'][-1]['id']
@@ -0,0 +1,132 @@
+import json
+
+import pytest
+
+import catalog
+import providers
+from conftest import runJobs
+from stubprovider import CLIENT_ID, StubProvider, closedUrl
+
+APP_SECRET = 'APP_SECRET_VALUE'
+
+
+@pytest.fixture
+def provider(app, tmpdir, monkeypatch):
+    # Every provider endpoint points to a local stub, as the CATALOG_*_URL
+    # environment variables would do
+    stub = StubProvider().start()
+    monkeypatch.setattr(providers, 'GOOGLE_TOKEN_URL', stub.url + '/token')
+    monkeypatch.setattr(providers, 'GOOGLE_API_URL', stub.url)
+    monkeypatch.setattr(providers, 'GOOGLE_ACCOUNTS_URL', stub.url)
+    monkeypatch.setattr(providers, 'FACEBOOK_GRAPH_URL', stub.url)
+    google = tmpdir.join('client_secrets.json')
+    google.write(json.dumps({'web': {
+        'client_id': CLIENT_ID, 'client_secret': 'secret'}}))
+    facebook = tmpdir.join('fb_client_secrets.json')
+    facebook.write(json.dumps({'web': {
+        'app_id': CLIENT_ID, 'app_secret': APP_SECRET}}))
+    monkeypatch.setitem(app.config, 'GOOGLE_SECRETS_FILE', str(google))
+    monkeypatch.setitem(app.config, 'FACEBOOK_SECRETS_FILE', str(facebook))
+    yield stub
+    stub.stop()
+
+
+def connect(client, provider_name, data):
+    with client.session_transaction() as login_session:
+        login_session['state'] = 'STATE'
+    return client.post('/%sconnect?state=STATE' % provider_name, data=data)
+
+
+def test_google_login_and_logout(client, provider):
+    response = connect(client, 'g', 'code-1')
+    assert response.status_code == 200
+    assert b'Welcome, Google User' in response.data
+    with client.session_transaction() as login_session:
+        assert login_session['provider'] == 'google'
+        assert login_session['user_id']
+    response = client.get('/disconnect')
+    assert response.status_code == 302
+    with client.session_transaction() as login_session:
+        assert 'username' not in login_session
+    runJobs()
+    assert provider.paths() == [
+        '/token', '/oauth2/v1/tokeninfo', '/oauth2/v1/userinfo',
+        '/o/oauth2/revoke']
+    # Every call went through one kept alive connection of the pool
+    assert provider.connections == 1
+
+
+def test_facebook_login_and_logout(client, provider):
+    response = connect(client, 'fb', 'short-token')
+    assert response.status_code == 200
+    assert b'Welcome, Facebook User' in response.data
+    client.get('/disconnect')
+    runJobs()
+    assert provider.paths() == [
+        '/oauth/access_token', '/v2.8/me', '/v2.8/me/picture',
+        '/facebook-user-1/permissions']
+    assert provider.connections == 1
+
+
+def test_logins_of_several_clients_share_the_pool(app, provider):
+    for number in range(3):
+        client = app.test_client()
+        assert connect(client, 'g', 'code-%d' % number).status_code == 200
+        assert connect(client, 'fb', 'token-%d' % number).status_code == 200
+    # Every code is exchanged, the google user is only validated once
+    paths = provider.paths()
+    assert paths.count('/token') == 3
+    assert paths.count('/oauth2/v1/tokeninfo') == 1
+    assert paths.count('/oauth/access_token') == 3
+    assert provider.connections == 1
+
+
+def test_rejected_code_is_reported(client, provider):
+    response = connect(client, 'g', 'bad')
+    assert response.status_code == 401
+    assert provider.paths() == ['/token']
+
+
+def test_replayed_google_code_is_sent_to_google(app, provider):
+    assert connect(app.test_client(), 'g', 'code-1').status_code == 200
+    # The code was used, a replay must not log in from the cache
+    response = connect(app.test_client(), 'g', 'code-1')
+    assert response.status_code == 401
+    assert provider.paths().count('/token') == 2
+
+
+def test_validated_google_user_is_cached(app, provider):
+    # Every code gives a new access token, the google id of the user is
+    # enough to skip the validation of the second one
+    first, second = app.test_client(), app.test_client()
+    assert connect(first, 'g', 'code-1').status_code == 200
+    assert connect(second, 'g', 'code-2').status_code == 200
+    assert provider.paths() == [
+        '/token', '/oauth2/v1/tokeninfo', '/oauth2/v1/userinfo', '/token']
+    with second.session_transaction() as login_session:
+        assert login_session['access_token'] == 'google-token-code-2'
+    with first.session_transaction() as login_session:
+        assert login_session['access_token'] == 'google-token-code-1'
+
+
+def test_unreachable_facebook_does_not_expose_secrets(
+        client, provider, monkeypatch, capsys, caplog):
+    monkeypatch.setattr(providers, 'FACEBOOK_GRAPH_URL', closedUrl())
+    response = connect(client, 'fb', 'short-token')
+    assert response.status_code == 401
+    output = capsys.readouterr().out + caplog.text
+    assert 'Facebook login failed: ProviderError' in output
+    assert APP_SECRET not in output
+    assert 'fb_exchange_token' not in output
+    assert APP_SECRET not in response.get_data(as_text=True)
+
+
+def test_unreachable_google_does_not_expose_the_token(
+        client, provider, monkeypatch, caplog):
+    # The code exchange works, tokeninfo can not be reached
+    monkeypatch.setattr(providers, 'GOOGLE_API_URL', closedUrl())
+    response = connect(client, 'g', 'code-1')
+    assert response.status_code == 500
+    body = response.get_data(as_text=True)
+    assert json.loads(body) == 'Failed to validate the token with google.'
+    assert 'google-token-code-1' not in body + caplog.text
@@ -0,0 +1,59 @@
+import subprocess
+import sys
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+
+from models import SchemaError, createSchema
+
+MODELS = __import__('models').__file__.replace('.pyc', '.py')
+
+
+@pytest.fixture
+def engine(tmpdir):
+    engine = create_engine('sqlite:///%s' % tmpdir.join('schema.db'))
+    createSchema(engine)
+    yield engine
+    engine.dispose()
+
+
+def test_missing_indexes_are_created(engine):
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_category_name'))
+    createSchema(engine)
+    indexes = [index['name'] for index in inspect(engine).get_indexes(
+        'category')]
+    assert 'ix_category_name' in indexes
+
+
+def test_duplicated_rows_fail_the_upgrade(engine, tmpdir):
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_category_name'))
+        connection.execute(text(
+            "INSERT INTO category (name, user_id) VALUES ('Same', 1)"))
+        connection.execute(text(
+            "INSERT INTO category (name, user_id) VALUES ('Same', 1)"))
+    with pytest.raises(SchemaError) as error:
+        createSchema(engine)
+    assert 'ix_category_name' in str(error.value)
+    status = subprocess.call(
+        [sys.executable, MODELS, str(engine.url)], cwd=str(tmpdir))
+    assert status == 1
+
+
+def test_indexes_declared_unique_later_are_rebuilt(engine):
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_user_email'))
+        connection.execute(text('CREATE INDEX ix_user_email ON user (email)'))
+        connection.execute(text(
+            "INSERT INTO user (name, email) VALUES ('a', 'same'), "
+            "('b', 'same')"))
+    with pytest.raises(SchemaError):
+        createSchema(engine)
+    # The old index is kept until the duplicated rows are removed
+    assert inspect(engine).get_indexes('user') == [{
+        'name': 'ix_user_email', 'column_names': ['email'], 'unique': 0}]
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM user WHERE name = 'b'"))
+    createSchema(engine)
+    assert inspect(engine).get_indexes('user')[0]['unique']
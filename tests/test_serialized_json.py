@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import pytest
+from flask import jsonify
+
+import catalog
+from conftest import login
+from models import Category, CatalogItem, Job, User
+
+
+@pytest.fixture
+def rows(app):
+    # Non ASCII text and NULL columns in every table
+    session = catalog.session
+    user = User(name=u'Zoë', email=None, picture=None)
+    other = User(name=u'Ann', email=u'ann@example.com', picture=u'é.png')
+    session.add_all([user, other])
+    session.flush()
+    cafe = Category(name=u'Café', user_id=user.id)
+    tea = Category(name=u'Tea', user_id=None)
+    session.add_all([cafe, tea])
+    session.flush()
+    session.add_all([
+        CatalogItem(title=u'Crème brûlée', description=None,
+                    category_id=cafe.id, user_id=user.id),
+        CatalogItem(title=u'Espresso', description=u'Strong ☕ "x"\n',
+                    category_id=cafe.id, user_id=other.id),
+        CatalogItem(title=u'Green', description=u'',
+                    category_id=tea.id, user_id=None),
+    ])
+    session.commit()
+    session.remove()
+    catalog.categoryDirectory.refresh()
+    catalog.session.remove()
+
+
+@pytest.fixture
+def fastPath(monkeypatch):
+    # The views must not fall back to jsonify
+    def unused(*args, **kwargs):
+        raise AssertionError('jsonify was used')
+    monkeypatch.setattr(catalog, 'jsonify', unused)
+
+
+def query(model):
+    return catalog.session.query(model).order_by(model.id).all()
+
+
+def bySeq(rows):
+    return sorted(rows, key=lambda row: row.change_seq)
+
+
+def expected(app, **payload):
+    with app.test_request_context():
+        return jsonify(**payload).get_data()
+
+
+def test_json_views_match_jsonify_of_serialize(app, rows, fastPath):
+    items, categories, users = (
+        query(CatalogItem), query(Category), query(User))
+    cafe = categories[0]
+    cafe_items = [item for item in items if item.category_id == cafe.id]
+    item = cafe_items[0]
+    stats = dict(
+        categories=[{'id': c.id, 'name': c.name, 'item_count': c.item_count}
+                    for c in categories],
+        users=[{'id': u.id, 'name': u.name, 'item_count': u.item_count}
+               for u in users],
+        total_categories=len(categories), total_users=len(users),
+        total_items=sum(c.item_count for c in categories))
+    views = [
+        (u'/catalog/item/JSON', dict(
+            categoryItems=[i.serialize for i in items], next=None)),
+        (u'/catalog/item/JSON?limit=2', dict(
+            categoryItems=[i.serialize for i in items[:2]],
+            next=items[1].id)),
+        (u'/catalog/item/JSON?ids=%d,999,%d' % (items[2].id, items[0].id),
+         dict(categoryItems=[items[2].serialize, items[0].serialize],
+              missing=[999])),
+        (u'/catalog/%d/item/JSON' % cafe.id, dict(
+            categoryItems=[i.serialize for i in cafe_items], next=None)),
+        (u'/catalog/Café/item/JSON', dict(
+            categoryItems=[i.serialize for i in cafe_items], next=None)),
+        (u'/catalog/%d/item/%d/JSON' % (cafe.id, item.id), dict(
+            category_Item=item.serialize)),
+        (u'/catalog/Café/Crème brûlée/JSON', dict(
+            category_Item=item.serialize)),
+        (u'/catalog/JSON', dict(
+            categories=[c.serialize for c in categories], next=None)),
+        (u'/catalog/%d/JSON' % cafe.id, dict(category=cafe.serialize)),
+        (u'/catalog/Café/JSON', dict(category=cafe.serialize)),
+        (u'/catalog/user/JSON', dict(
+            users=[u.serialize for u in users], next=None)),
+        (u'/catalog/user/JSON?ids=%d' % users[0].id, dict(
+            users=[users[0].serialize], missing=[])),
+        (u'/catalog/user/%d/JSON' % users[0].id, dict(
+            user=users[0].serialize)),
+        (u'/catalog/changes/JSON', dict(
+            categories=[dict(c.serialize, change_seq=c.change_seq)
+                        for c in bySeq(categories)],
+            items=[dict(i.serialize, change_seq=i.change_seq)
+                   for i in bySeq(items)],
+            deleted=[], next=max(i.change_seq for i in items + categories),
+            more=False)),
+        (u'/catalog/stats/JSON', stats),
+        (u'/search/JSON?q=crème', dict(
+            categoryItems=[dict(item.serialize, category=u'Café')],
+            next=None)),
+    ]
+    client = app.test_client()
+    for url, payload in views:
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert response.get_data() == expected(app, **payload), url
+
+
+def test_job_view_matches_jsonify_of_serialize(app, rows, fastPath):
+    user_id = query(User)[0].id
+    job_id = catalog.jobQueue.enqueue('repair_item_counts', user_id=user_id)
+    job = catalog.session.query(Job).get(job_id)
+    client = app.test_client()
+    login(client, user_id)
+    response = client.get('/catalog/job/%d/JSON' % job_id)
+    assert response.get_data() == expected(app, job=job.serialize)
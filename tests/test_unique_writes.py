@@ -0,0 +1,160 @@
+import threading
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import catalog
+from conftest import addUser, login
+from models import Category, CatalogItem, SchemaError, createSchema, \
+    requireUniqueIndexes
+
+THREADS = 16
+
+
+def concurrently(app, user_id, send, count=THREADS):
+    # Run send(client, number) from count threads released together and
+    # return the status codes of their responses
+    start = threading.Event()
+    statuses = []
+    errors = []
+
+    def run(number):
+        client = app.test_client()
+        login(client, user_id)
+        start.wait()
+        try:
+            statuses.append(send(client, number).status_code)
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=run, args=(number,))
+               for number in range(count)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    return statuses
+
+
+def addCategories(user_id, names):
+    session = catalog.session
+    categories = [Category(name=name, user_id=user_id) for name in names]
+    session.add_all(categories)
+    session.commit()
+    ids = [category.id for category in categories]
+    session.remove()
+    catalog.categoryDirectory.refresh()
+    catalog.session.remove()
+    return ids
+
+
+def addItems(user_id, category_id, titles):
+    session = catalog.session
+    session.add_all([CatalogItem(title=title, description='',
+                                 category_id=category_id, user_id=user_id)
+                     for title in titles])
+    session.query(Category).filter_by(id=category_id).update(
+        {Category.item_count: Category.item_count + len(titles)})
+    session.commit()
+    session.remove()
+
+
+def names():
+    rows = catalog.session.query(Category.name).all()
+    catalog.session.remove()
+    return sorted(name for (name,) in rows)
+
+
+def titles():
+    rows = catalog.session.query(CatalogItem.title).all()
+    catalog.session.remove()
+    return sorted(title for (title,) in rows)
+
+
+def test_new_categories_with_the_same_name(app):
+    user_id = addUser()
+    statuses = concurrently(app, user_id, lambda client, number: client.post(
+        '/catalog/new', data={'name': 'Same'}))
+    assert statuses == [302] * THREADS
+    assert names() == ['Same']
+
+
+def test_categories_renamed_to_the_same_name(app):
+    user_id = addUser()
+    original = ['Category %02d' % number for number in range(THREADS)]
+    addCategories(user_id, original)
+    statuses = concurrently(app, user_id, lambda client, number: client.post(
+        '/catalog/Category %02d/edit' % number, data={'name': 'Same'}))
+    assert statuses == [302] * THREADS
+    result = names()
+    assert result.count('Same') == 1
+    assert len(result) == THREADS
+    assert len(set(result) - set(original)) == 1
+
+
+def test_new_items_with_the_same_title(app):
+    user_id = addUser()
+    category_id, = addCategories(user_id, ['Soccer'])
+    statuses = concurrently(app, user_id, lambda client, number: client.post(
+        '/catalog/item/new',
+        data={'title': 'Ball', 'description': '', 'category': 'Soccer'}))
+    assert statuses == [302] * THREADS
+    assert titles() == ['Ball']
+    # Rejected inserts do not change the counters
+    category = catalog.session.query(Category).get(category_id)
+    assert category.item_count == 1
+
+
+def test_items_renamed_to_the_same_title(app):
+    user_id = addUser()
+    category_id, = addCategories(user_id, ['Soccer'])
+    original = ['Item %02d' % number for number in range(THREADS)]
+    addItems(user_id, category_id, original)
+    statuses = concurrently(app, user_id, lambda client, number: client.post(
+        '/catalog/Soccer/Item %02d/edit' % number,
+        data={'title': 'Same', 'description': '', 'category': 'Soccer'}))
+    assert statuses == [302] * THREADS
+    result = titles()
+    assert result.count('Same') == 1
+    assert len(result) == THREADS
+
+
+def test_writes_require_the_unique_indexes(tmpdir):
+    engine = create_engine('sqlite:///%s' % tmpdir.join('indexes.db'))
+    createSchema(engine)
+    requireUniqueIndexes(engine)
+    with engine.begin() as connection:
+        connection.execute(text(
+            'DROP INDEX ix_category_item_category_id_title'))
+    with pytest.raises(SchemaError) as error:
+        requireUniqueIndexes(engine)
+    assert 'ix_category_item_category_id_title' in str(error.value)
+    engine.dispose()
+
+
+def test_first_logins_with_the_same_email(app):
+    start = threading.Event()
+    user_ids = []
+    errors = []
+
+    def run():
+        with app.app_context():
+            start.wait()
+            try:
+                user_ids.append(catalog.createUser({
+                    'username': 'Same', 'email': 'same@example.com',
+                    'picture': ''}))
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=run) for number in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert len(user_ids) == THREADS
+    assert len(set(user_ids)) == 1